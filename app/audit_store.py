@@ -0,0 +1,60 @@
+import os
+import hashlib
+import tempfile
+
+# Кадры ручных оплат для отчёта администратору. Файл называется по sha256 содержимого,
+# поэтому повторная отправка того же кадра не создаёт копию. Каталог не должен раздаваться через /static.
+AUDIT_DIR = os.getenv("AUDIT_DIR", "/app/audit_frames")
+CHUNK = 64 * 1024
+
+class AuditFrameStore:
+    def __init__(self, root=AUDIT_DIR):
+        self.root = root
+
+    def path_for(self, digest):
+        return os.path.join(self.root, digest[:2], f"{digest}.jpg")
+
+    # save/save_bytes возвращают (путь, создан ли файл сейчас): только что созданный кадр
+    # можно удалить, если оплата не прошла, — на уже существовавший мог сослаться другой отчёт
+    def save(self, fileobj):
+        # Пишем во временный файл, считая хэш на лету, затем атомарно переносим на место
+        os.makedirs(self.root, exist_ok=True)
+        sha = hashlib.sha256()
+        fd, tmp = tempfile.mkstemp(dir=self.root, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as out:
+                while True:
+                    chunk = fileobj.read(CHUNK)
+                    if not chunk:
+                        break
+                    sha.update(chunk)
+                    out.write(chunk)
+            path = self.path_for(sha.hexdigest())
+            if os.path.exists(path):
+                os.remove(tmp)
+                return path, False
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp, path)
+            return path, True
+        except BaseException:
+            if os.path.exists(tmp): os.remove(tmp)
+            raise
+
+    def save_bytes(self, data):
+        path = self.path_for(hashlib.sha256(data).hexdigest())
+        if os.path.exists(path):
+            return path, False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".part")
+        with os.fdopen(fd, "wb") as out:
+            out.write(data)
+        os.replace(tmp, path)
+        return path, True
+
+    def discard(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+AUDIT_STORE = AuditFrameStore()
@@ -0,0 +1,166 @@
+import os
+import asyncio
+import zipfile
+import tempfile
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from fastapi.concurrency import run_in_threadpool
+from app.cv_utils import get_face_embedding, _warm_worker, CV_POOL, CVPoolBusy
+from app.face_codec import encode_embedding
+from app.face_store import FACE_STORE, FACE_VERSION_KEY
+from app.cache_versions import bump_version
+from app.models import Employee, Card
+
+BULK_ENROLL_WORKERS = int(os.getenv("BULK_ENROLL_WORKERS", str(os.cpu_count() or 2)))
+BULK_ENROLL_BATCH = int(os.getenv("BULK_ENROLL_BATCH", "100"))
+# Ограничения для загрузки через API (CLI читает локальные файлы без ограничений)
+BULK_ENROLL_MAX_BYTES = int(os.getenv("BULK_ENROLL_MAX_BYTES", str(500 * 2**20)))
+BULK_ENROLL_MAX_FILES = int(os.getenv("BULK_ENROLL_MAX_FILES", "10000"))
+BULK_ENROLL_MAX_PHOTO_BYTES = int(os.getenv("BULK_ENROLL_MAX_PHOTO_BYTES", str(10 * 2**20)))
+# Сколько фото одновременно отдаём в общий CV_POOL — остальная мощность остаётся кассам
+BULK_ENROLL_POOL_SHARE = int(os.getenv("BULK_ENROLL_POOL_SHARE", "2"))
+PHOTO_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+class ArchiveTooLarge(Exception):
+    pass
+
+def spool_upload(src, max_bytes=BULK_ENROLL_MAX_BYTES):
+    # Копия загрузки в настоящий временный файл: SpooledTemporaryFile на Python 3.10
+    # не поддерживает seekable(), и zipfile на нём падает с AttributeError
+    dst = tempfile.TemporaryFile()
+    try:
+        copied = 0
+        while True:
+            chunk = src.read(2**20)
+            if not chunk:
+                break
+            copied += len(chunk)
+            if copied > max_bytes:
+                raise ArchiveTooLarge(f"Архив больше {max_bytes // 2**20} МБ")
+            dst.write(chunk)
+        dst.seek(0)
+        return dst
+    except BaseException:
+        dst.close()
+        raise
+
+def _photo_entries(zf, max_files, max_photo_bytes):
+    entries = []
+    for info in zf.infolist():
+        name = os.path.basename(info.filename)
+        if info.is_dir() or name.startswith(".") or not name.lower().endswith(PHOTO_EXTENSIONS):
+            continue
+        if max_photo_bytes is not None and info.file_size > max_photo_bytes:
+            raise ArchiveTooLarge(f"{info.filename}: фото больше {max_photo_bytes // 2**20} МБ")
+        entries.append((info, name))
+    if max_files is not None and len(entries) > max_files:
+        raise ArchiveTooLarge(f"В архиве больше {max_files} фото")
+    return entries
+
+def iter_photos(source, max_files=None, max_photo_bytes=None):
+    # Отдаёт (имя файла, card_uid, байты) из ZIP-архива (путь или файловый объект) или каталога
+    if not isinstance(source, (str, os.PathLike)) or not os.path.isdir(source):
+        with zipfile.ZipFile(source) as zf:
+            # Лимиты проверяем по оглавлению архива до распаковки
+            for info, name in _photo_entries(zf, max_files, max_photo_bytes):
+                yield info.filename, os.path.splitext(name)[0].strip(), zf.read(info)
+        return
+    for name in sorted(os.listdir(source)):
+        if name.lower().endswith(PHOTO_EXTENSIONS):
+            with open(os.path.join(source, name), "rb") as f:
+                yield name, os.path.splitext(name)[0].strip(), f.read()
+
+def save_enrollments(db, items, photos_dir):
+    # items: [(card_uid, jpeg_bytes, embedding)] — одна транзакция на всю пачку
+    cards = dict(db.query(Card.uid, Card.employee_id).filter(Card.uid.in_([uid for uid, _, _ in items])).all())
+    statuses, mappings, enrolled = {}, [], []
+    os.makedirs(photos_dir, exist_ok=True)
+    for uid, content, emb in items:
+        emp_id = cards.get(uid)
+        if emp_id is None:
+            statuses[uid] = "card_not_found"
+            continue
+        with open(os.path.join(photos_dir, f"{uid}.jpg"), "wb") as f: f.write(content)
+        mappings.append({"id": emp_id, "face_embedding": encode_embedding(emb)})
+        enrolled.append((emp_id, uid, emb))
+        statuses[uid] = "ok"
+    if mappings:
+        db.bulk_update_mappings(Employee, mappings)
+        version = bump_version(db, FACE_VERSION_KEY)
+        db.commit()
+        for emp_id, uid, emb in enrolled:
+            FACE_STORE.upsert(emp_id, [uid], emb, version=version)
+    return statuses
+
+def _encode_photo(content):
+    return get_face_embedding(content)
+
+def enroll_photos(db, photos, photos_dir, workers=BULK_ENROLL_WORKERS, batch_size=BULK_ENROLL_BATCH):
+    # Кодируем лица параллельно в пуле процессов, пишем в БД пачками по batch_size
+    report = []
+    executor = ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn"), initializer=_warm_worker
+    )
+    try:
+        batch = []
+        for photo in photos:
+            batch.append(photo)
+            if len(batch) >= batch_size:
+                report += _enroll_batch(db, executor, batch, photos_dir)
+                batch = []
+        if batch:
+            report += _enroll_batch(db, executor, batch, photos_dir)
+    finally:
+        executor.shutdown()
+    return report
+
+async def _encode_in_pool(key, content, share):
+    # Фото идут через общий CV_POOL наравне с кассами; отдельный пул процессов в веб-воркере не создаём
+    async with share:
+        while True:
+            try:
+                return await CV_POOL.submit(key, get_face_embedding, content)
+            except CVPoolBusy:
+                await asyncio.sleep(0.5)
+
+async def enroll_photos_async(db, photos, photos_dir, share=BULK_ENROLL_POOL_SHARE, batch_size=BULK_ENROLL_BATCH):
+    # Вариант enroll_photos для API: кодирование в CV_POOL, не больше share фото одновременно
+    report, sem, seq = [], asyncio.Semaphore(max(1, share)), itertools.count()
+    while True:
+        batch = await run_in_threadpool(lambda: list(itertools.islice(photos, batch_size)))
+        if not batch:
+            return report
+        # Свой ключ на фото: очередь CV_POOL не вытесняет фото из одного архива друг другом
+        embeddings = await asyncio.gather(*(
+            _encode_in_pool(f"bulk:{next(seq)}", content, sem) for _, _, content in batch
+        ))
+        report += await run_in_threadpool(_save_batch, db, batch, embeddings, photos_dir)
+
+def _enroll_batch(db, executor, batch, photos_dir):
+    embeddings = list(executor.map(_encode_photo, [content for _, _, content in batch]))
+    return _save_batch(db, batch, embeddings, photos_dir)
+
+def _save_batch(db, batch, embeddings, photos_dir):
+    rows, items = [], []
+    for (name, uid, content), emb in zip(batch, embeddings):
+        row = {"file": name, "card_uid": uid, "status": "no_face"}
+        if emb is not None:
+            items.append((uid, content, emb))
+        rows.append(row)
+    try:
+        statuses = save_enrollments(db, items, photos_dir) if items else {}
+    except Exception as e:
+        db.rollback()
+        print(f"ERROR: Bulk enroll batch failed: {e}")
+        statuses = {uid: "error" for uid, _, _ in items}
+    for row in rows:
+        if row["card_uid"] in statuses:
+            row["status"] = statuses[row["card_uid"]]
+    return rows
+
+def summarize(report):
+    counts = {}
+    for row in report:
+        counts[row["status"]] = counts.get(row["status"], 0) + 1
+    return {"total": len(report), "counts": counts, "files": report}
@@ -0,0 +1,14 @@
+from sqlalchemy.dialects.postgresql import insert
+from app.models import CacheVersion
+
+# Счётчики версий в БД: по ним кэши в памяти каждого воркера понимают, что данные поменялись
+
+def bump_version(db, name):
+    # Увеличиваем счётчик в той же транзакции, что и изменение данных
+    stmt = insert(CacheVersion).values(name=name, version=1).on_conflict_do_update(
+        index_elements=[CacheVersion.name], set_={"version": CacheVersion.version + 1}
+    ).returning(CacheVersion.version)
+    return db.execute(stmt).scalar()
+
+def read_version(db, name):
+    return db.query(CacheVersion.version).filter(CacheVersion.name == name).scalar() or 0
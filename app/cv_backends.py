@@ -0,0 +1,72 @@
+import os
+import numpy as np
+import face_recognition
+
+# Детектор и кодировщик выбираются независимо: CV_DETECTOR=dlib_hog|mediapipe, CV_ENCODER=dlib_resnet
+CV_DETECTOR = os.getenv("CV_DETECTOR", "dlib_hog")
+CV_ENCODER = os.getenv("CV_ENCODER", "dlib_resnet")
+MEDIAPIPE_MIN_CONFIDENCE = float(os.getenv("MEDIAPIPE_MIN_CONFIDENCE", "0.5"))
+
+DETECTORS = {}
+ENCODERS = {}
+_instances = {}
+
+def register_detector(name):
+    def wrap(cls):
+        DETECTORS[name] = cls
+        return cls
+    return wrap
+
+def register_encoder(name):
+    def wrap(cls):
+        ENCODERS[name] = cls
+        return cls
+    return wrap
+
+def _get(registry, name):
+    # Один экземпляр на процесс: модели грузятся один раз в каждом CV-воркере
+    if name not in registry:
+        raise ValueError(f"Unknown CV backend: {name}. Available: {', '.join(registry)}")
+    key = (id(registry), name)
+    if key not in _instances:
+        _instances[key] = registry[name]()
+    return _instances[key]
+
+def get_detector(name=None):
+    return _get(DETECTORS, name or CV_DETECTOR)
+
+def get_encoder(name=None):
+    return _get(ENCODERS, name or CV_ENCODER)
+
+# Рамки везде в формате face_recognition: (top, right, bottom, left) в пикселях RGB-изображения
+@register_detector("dlib_hog")
+class DlibHogDetector:
+    def detect(self, rgb):
+        return face_recognition.face_locations(rgb, model="hog")
+
+@register_detector("mediapipe")
+class MediaPipeDetector:
+    def __init__(self):
+        import mediapipe as mp
+        # model_selection=0 — модель ближнего радиуса (до ~2 м), как раз для камеры на кассе
+        self._detector = mp.solutions.face_detection.FaceDetection(
+            model_selection=0, min_detection_confidence=MEDIAPIPE_MIN_CONFIDENCE
+        )
+
+    def detect(self, rgb):
+        h, w = rgb.shape[:2]
+        result = self._detector.process(np.ascontiguousarray(rgb))
+        boxes = []
+        for det in result.detections or []:
+            bb = det.location_data.relative_bounding_box
+            left, top = max(0, int(bb.xmin * w)), max(0, int(bb.ymin * h))
+            right, bottom = min(w, int((bb.xmin + bb.width) * w)), min(h, int((bb.ymin + bb.height) * h))
+            if right > left and bottom > top:
+                boxes.append((top, right, bottom, left))
+        return boxes
+
+@register_encoder("dlib_resnet")
+class DlibResnetEncoder:
+    def encode(self, rgb, box):
+        encodings = face_recognition.face_encodings(rgb, known_face_locations=[box])
+        return encodings[0] if encodings else None
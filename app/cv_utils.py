@@ -1,6 +1,35 @@
+import os
+import time
+import asyncio
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import face_recognition
 import numpy as np
 import cv2
+from app.cv_backends import get_detector, get_encoder
+
+# --- Настройки пула CV-воркеров ---
+# CV_WORKERS=0 — считать в пуле потоков (без отдельных процессов), полезно для отладки
+CV_WORKERS = int(os.getenv("CV_WORKERS", str(max(1, (os.cpu_count() or 2) - 1))))
+CV_MAX_QUEUE = int(os.getenv("CV_MAX_QUEUE", "32"))          # Общий лимит ожидающих кадров
+CV_MAX_QUEUE_PER_KEY = int(os.getenv("CV_MAX_QUEUE_PER_KEY", "2"))  # Лимит на одну кассу
+FACE_TOLERANCE = float(os.getenv("FACE_TOLERANCE", "0.6"))
+
+# --- Настройки конвейера кадра ---
+CV_DECODE_SCALE = int(os.getenv("CV_DECODE_SCALE", "2"))          # 1, 2, 4 или 8 — во сколько раз уменьшаем при декодировании
+CV_ROI_MARGIN = float(os.getenv("CV_ROI_MARGIN", "0.5"))           # Запас вокруг прошлого лица (доля от его размера)
+CV_ENCODE_MIN_FACE = int(os.getenv("CV_ENCODE_MIN_FACE", "100"))   # Меньше — кодируем по полноразмерному кадру
+
+# --- Фильтр качества кадра (до дорогого кодирования) ---
+CV_QUALITY_GATE = os.getenv("CV_QUALITY_GATE", "1") == "1"
+CV_MIN_SHARPNESS = float(os.getenv("CV_MIN_SHARPNESS", "40"))     # Дисперсия Лапласиана на уменьшенном кадре
+CV_MIN_BRIGHTNESS = float(os.getenv("CV_MIN_BRIGHTNESS", "40"))
+CV_MAX_BRIGHTNESS = float(os.getenv("CV_MAX_BRIGHTNESS", "215"))
+CV_MAX_CLIPPED = float(os.getenv("CV_MAX_CLIPPED", "0.35"))       # Доля пересвеченных/провальных пикселей
+CV_MIN_FACE_PX = int(os.getenv("CV_MIN_FACE_PX", "80"))           # Минимальная высота лица в полном кадре
+_DECODE_FLAGS = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
 
 def get_face_embedding(image_bytes):
     try:
@@ -9,21 +38,20 @@ def get_face_embedding(image_bytes):
         img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
         if img is None:
             return None
-            
+
         # Конвертируем в RGB (face_recognition работает с RGB)
         rgb_img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        
-        # Ищем лица и создаем эмбеддинги
-        encodings = face_recognition.face_encodings(rgb_img)
-        
-        if len(encodings) > 0:
-            return encodings[0]
-        return None
+
+        # Ищем лицо выбранным детектором и создаем эмбеддинг
+        box = _largest(get_detector().detect(rgb_img))
+        if box is None:
+            return None
+        return get_encoder().encode(rgb_img, box)
     except Exception as e:
         print(f"CV Error: {e}")
         return None
 
-def compare_faces(embedding1, embedding2, tolerance=0.6):
+def compare_faces(embedding1, embedding2, tolerance=FACE_TOLERANCE):
     try:
         # Сравниваем два вектора лиц
         results = face_recognition.compare_faces([embedding1], embedding2, tolerance=tolerance)
@@ -31,3 +59,216 @@ def compare_faces(embedding1, embedding2, tolerance=0.6):
     except Exception as e:
         print(f"Comparison Error: {e}")
         return False
+
+# --- ДВУХСТАДИЙНЫЙ КОНВЕЙЕР КАДРА ---
+def _largest(boxes):
+    return max(boxes, key=lambda b: (b[2] - b[0]) * (b[1] - b[3])) if boxes else None
+
+def _expand(box, margin, shape):
+    top, right, bottom, left = box
+    m = int(max(bottom - top, right - left) * margin)
+    return max(0, top - m), min(shape[1], right + m), min(shape[0], bottom + m), max(0, left - m)
+
+def check_quality(gray):
+    # Дешёвые проверки (~1 мс на 320x240): резкость и экспозиция
+    if cv2.Laplacian(gray, cv2.CV_64F).var() < CV_MIN_SHARPNESS:
+        return "blurry"
+    hist = cv2.calcHist([gray], [0], None, [256], [0, 256]).ravel()
+    total = hist.sum()
+    mean = float(np.dot(hist, np.arange(256)) / total)
+    clipped = float((hist[:8].sum() + hist[248:].sum()) / total)
+    if mean < CV_MIN_BRIGHTNESS or (clipped > CV_MAX_CLIPPED and mean < 128):
+        return "too_dark"
+    if mean > CV_MAX_BRIGHTNESS or clipped > CV_MAX_CLIPPED:
+        return "too_bright"
+    return None
+
+def check_face_box(box, shape, scale):
+    top, right, bottom, left = box
+    if (bottom - top) * scale < CV_MIN_FACE_PX:
+        return "face_too_small"
+    # Рамка упирается в край кадра — лицо частично вне кадра
+    if top <= 1 or left <= 1 or bottom >= shape[0] - 1 or right >= shape[1] - 1:
+        return "face_partial"
+    return None
+
+def _detect(rgb, roi):
+    # Сначала ищем лицо в окрестности прошлой рамки, и только если его там нет — по всему кадру
+    if roi is not None:
+        y0, x1, y1, x0 = _expand(roi, CV_ROI_MARGIN, rgb.shape)
+        box = _largest(get_detector().detect(rgb[y0:y1, x0:x1]))
+        if box is not None:
+            return box[0] + y0, box[1] + x0, box[2] + y0, box[3] + x0
+    return _largest(get_detector().detect(rgb))
+
+def _encode_crop(rgb, box):
+    # Кодируем только вырезанное лицо с небольшим запасом для поиска ключевых точек
+    y0, x1, y1, x0 = _expand(box, 0.25, rgb.shape)
+    top, right, bottom, left = box
+    return get_encoder().encode(rgb[y0:y1, x0:x1], (top - y0, right - x0, bottom - y0, left - x0))
+
+def process_frame(image_bytes, roi=None, scale=CV_DECODE_SCALE):
+    # Возвращает эмбеддинг, рамку лица (в координатах полного кадра) и время каждой стадии в мс
+    result = {"embedding": None, "box": None, "reason": None, "timings": {}}
+    timings = result["timings"]
+    if scale not in _DECODE_FLAGS: scale = 1
+    try:
+        t0 = time.perf_counter()
+        buf = np.frombuffer(image_bytes, np.uint8)
+        small = cv2.imdecode(buf, _DECODE_FLAGS[scale])
+        if small is None:
+            result["reason"] = "bad_image"
+            return result
+        t1 = time.perf_counter(); timings["decode"] = round((t1 - t0) * 1000, 1)
+        if CV_QUALITY_GATE:
+            result["reason"] = check_quality(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY))
+            tq = time.perf_counter(); timings["quality"] = round((tq - t1) * 1000, 1); t1 = tq
+            if result["reason"]:
+                return result
+        small_rgb = cv2.cvtColor(small, cv2.COLOR_BGR2RGB)
+
+        small_roi = tuple(v // scale for v in roi) if roi else None
+        box = _detect(small_rgb, small_roi)
+        t2 = time.perf_counter(); timings["detect"] = round((t2 - t1) * 1000, 1)
+        if box is None:
+            result["reason"] = "no_face"
+            return result
+        result["box"] = [v * scale for v in box]
+        if CV_QUALITY_GATE:
+            result["reason"] = check_face_box(box, small_rgb.shape, scale)
+            if result["reason"]:
+                return result
+
+        if box[2] - box[0] >= CV_ENCODE_MIN_FACE or scale == 1:
+            result["embedding"] = _encode_crop(small_rgb, box)
+        else:
+            # Лицо мелкое — для точности кодируем по полноразмерному кадру, но только вырезанную область
+            full_rgb = cv2.cvtColor(cv2.imdecode(buf, cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+            result["embedding"] = _encode_crop(full_rgb, tuple(result["box"]))
+        timings["encode"] = round((time.perf_counter() - t2) * 1000, 1)
+        if result["embedding"] is None:
+            result["reason"] = "no_face"
+        return result
+    except Exception as e:
+        print(f"CV Error: {e}")
+        result["reason"] = "error"
+        return result
+
+def face_distances(known_matrix, embedding):
+    # Расстояния от кадра сразу до всех шаблонов одной векторной операцией
+    return np.linalg.norm(known_matrix - np.asarray(embedding, dtype=np.float32), axis=1)
+
+# --- ПУЛ CV-ВОРКЕРОВ ---
+class CVPoolBusy(Exception):
+    pass
+
+def _warm_worker():
+    # Прогреваем выбранные модели в каждом процессе, чтобы первый кадр не платил за загрузку
+    blank = np.zeros((64, 64, 3), dtype=np.uint8)
+    get_detector().detect(blank)
+    get_encoder().encode(blank, (8, 56, 56, 8))
+
+# Очередь кадров перед пулом процессов: общий лимит, лимит на кассу и обход касс по кругу
+class CVPool:
+    def __init__(self, workers=CV_WORKERS, max_queue=CV_MAX_QUEUE, max_queue_per_key=CV_MAX_QUEUE_PER_KEY):
+        self.workers = max(1, workers)
+        self.use_processes = workers > 0
+        self.max_queue = max_queue
+        self.max_queue_per_key = max_queue_per_key
+        self._executor = None
+        self._queues = OrderedDict()  # key -> deque[(fn, args, future)]
+        self._pending = 0
+        self._inflight = 0
+
+    def _get_executor(self):
+        if self._executor is None and self.use_processes:
+            # spawn: не тащим в воркеры соединения с БД и поток бота из родителя
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_warm_worker,
+            )
+        return self._executor
+
+    async def submit(self, key, fn, *args):
+        if self._pending >= self.max_queue:
+            raise CVPoolBusy("CV queue is full")
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        q = self._queues.setdefault(key, deque())
+        if len(q) >= self.max_queue_per_key:
+            # Старый кадр этой кассы уже неактуален — уступаем место новому
+            _, _, stale = q.popleft()
+            self._pending -= 1
+            if not stale.done():
+                stale.set_exception(CVPoolBusy("Superseded by a newer frame"))
+        q.append((fn, args, fut))
+        self._pending += 1
+        self._dispatch()
+        return await fut
+
+    def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while self._inflight < self.workers and self._queues:
+            # Берём по одному кадру от каждой кассы по очереди
+            key, q = next(iter(self._queues.items()))
+            fn, args, fut = q.popleft()
+            self._pending -= 1
+            if q: self._queues.move_to_end(key)
+            else: del self._queues[key]
+            if fut.done():
+                continue
+            executor = self._get_executor()
+            try:
+                try:
+                    job = loop.run_in_executor(executor, fn, *args)
+                except BrokenProcessPool:
+                    # Пул сломался, а колбэки его задач ещё не отработали — пересоздаём сразу
+                    self._drop_executor(executor)
+                    executor = self._get_executor()
+                    job = loop.run_in_executor(executor, fn, *args)
+            except Exception as e:
+                fut.set_exception(e)
+                continue
+            self._inflight += 1
+            job.add_done_callback(lambda j, fut=fut, ex=executor: self._on_done(j, fut, ex))
+
+    def _on_done(self, job, fut, executor=None):
+        self._inflight -= 1
+        if job.cancelled():
+            fut.cancel()
+        else:
+            error = job.exception()
+            if isinstance(error, BrokenProcessPool):
+                # Процесс-воркер упал (например, dlib на битом кадре): ошибку получают только кадры,
+                # которые были в этом пуле, а следующие уйдут в новый пул
+                self._drop_executor(executor)
+            if not fut.done():
+                if error is not None: fut.set_exception(error)
+                else: fut.set_result(job.result())
+        self._dispatch()
+
+    def _drop_executor(self, executor):
+        # Сбрасываем только тот пул, что сломался: колбэки старых задач не трогают уже пересозданный
+        if executor is None or executor is not self._executor:
+            return
+        print("WARNING: CV worker process died, restarting the pool")
+        self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def load(self):
+        # 0 — все воркеры свободны, 1 — все заняты, >1 — есть очередь
+        return (self._inflight + self._pending) / self.workers
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+CV_POOL = CVPool()
+
+async def get_face_embedding_async(image_bytes, key="default"):
+    return await CV_POOL.submit(key, get_face_embedding, image_bytes)
+
+async def process_frame_async(image_bytes, key="default", roi=None):
+    return await CV_POOL.submit(key, process_frame, image_bytes, roi)
@@ -0,0 +1,159 @@
+import io
+import os
+import csv
+from datetime import datetime, time, timedelta
+from sqlalchemy import select
+from app.database import SessionLocal
+from app.models import Transaction, Employee
+
+# Выгрузка транзакций за период: CSV для Excel и колоночные Parquet/Arrow для аналитики.
+# Все форматы читают один и тот же запрос серверным курсором пачками по EXPORT_CHUNK_ROWS строк
+EXPORT_COLUMNS = ("employee", "split", "items")
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", "2000"))
+COLUMNAR_FORMATS = {
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+    "arrow": ("application/vnd.apache.arrow.stream", "arrows"),
+}
+
+def period_filter(start_date, end_date):
+    # Границы периода сравниваем с самим created_at, без func.date — работает индекс
+    return (Transaction.created_at >= datetime.combine(start_date, time.min),
+            Transaction.created_at < datetime.combine(end_date + timedelta(days=1), time.min))
+
+def export_query(start_date, end_date, with_employee=False):
+    fields = [Transaction.id, Transaction.created_at, Transaction.cash_desk_id, Transaction.payment_method,
+              Transaction.employee_id, Transaction.amount_total_kopecks, Transaction.subsidy_part_kopecks,
+              Transaction.limit_part_kopecks, Transaction.items]
+    if with_employee:
+        fields.append(Employee.full_name)
+    query = select(*fields).where(*period_filter(start_date, end_date)).order_by(Transaction.created_at, Transaction.id)
+    if with_employee:
+        query = query.outerjoin(Employee, Employee.id == Transaction.employee_id)
+    return query
+
+def iter_batches(start_date, end_date, with_employee=False):
+    # Своя сессия: генератор читается уже после выхода из обработчика.
+    # Серверный курсор отдаёт строки пачками, в памяти не больше одной пачки
+    db = SessionLocal()
+    try:
+        query = export_query(start_date, end_date, with_employee)
+        result = db.execute(query.execution_options(stream_results=True, yield_per=EXPORT_CHUNK_ROWS))
+        for rows in result.partitions():
+            yield rows
+    finally:
+        db.close()
+
+# --- CSV ---
+def rub(kopecks):
+    return f"{(kopecks or 0) / 100:.2f}".replace('.', ',')  # Запятая лучше для русского Excel
+
+def items_cell(items):
+    counts = {}
+    for i in items or []:
+        counts[i.get("name")] = counts.get(i.get("name"), 0) + 1
+    return ", ".join(f"{name} ×{qty}" if qty > 1 else str(name) for name, qty in counts.items())
+
+def iter_export_csv(start_date, end_date, columns):
+    header = ["ID", "Дата", "Касса", "Метод", "Сумма (РУБ)"]
+    if "employee" in columns: header.append("Сотрудник")
+    if "split" in columns: header += ["Дотация (РУБ)", "Лимит (РУБ)"]
+    if "items" in columns: header.append("Состав")
+
+    stream = io.StringIO()
+    writer = csv.writer(stream, delimiter=';', dialect='excel')
+    stream.write('\ufeff')  # BOM, чтобы Excel открыл UTF-8
+    writer.writerow(header)
+    for rows in iter_batches(start_date, end_date, with_employee="employee" in columns):
+        for t in rows:
+            line = [t.id, t.created_at.strftime("%Y-%m-%d %H:%M") if t.created_at else "",
+                    t.cash_desk_id, t.payment_method, rub(t.amount_total_kopecks)]
+            if "employee" in columns: line.append(t.full_name or "")
+            if "split" in columns: line += [rub(t.subsidy_part_kopecks), rub(t.limit_part_kopecks)]
+            if "items" in columns: line.append(items_cell(t.items))
+            writer.writerow(line)
+        yield stream.getvalue().encode("utf-8")
+        stream.seek(0); stream.truncate(0)
+    if stream.tell():
+        yield stream.getvalue().encode("utf-8")
+
+# --- Parquet / Arrow (pyarrow — необязательная зависимость) ---
+def columnar_available():
+    try:
+        import pyarrow  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+def export_schema():
+    import pyarrow as pa
+    # Копейки остаются целыми, время — нативный timestamp, состав заказа — вложенный список
+    return pa.schema([
+        ("id", pa.int64()),
+        ("created_at", pa.timestamp("us", tz="UTC")),
+        ("cash_desk_id", pa.string()),
+        ("payment_method", pa.string()),
+        ("employee_id", pa.int64()),
+        ("employee_name", pa.string()),
+        ("amount_total_kopecks", pa.int64()),
+        ("subsidy_part_kopecks", pa.int64()),
+        ("limit_part_kopecks", pa.int64()),
+        ("items", pa.list_(pa.struct([("name", pa.string()), ("price", pa.int64()), ("product_id", pa.int64())]))),
+    ])
+
+def to_record_batch(rows, schema):
+    import pyarrow as pa
+    columns = {
+        "id": [r.id for r in rows],
+        "created_at": [r.created_at for r in rows],
+        "cash_desk_id": [r.cash_desk_id for r in rows],
+        "payment_method": [r.payment_method for r in rows],
+        "employee_id": [r.employee_id for r in rows],
+        "employee_name": [r.full_name for r in rows],
+        "amount_total_kopecks": [r.amount_total_kopecks for r in rows],
+        "subsidy_part_kopecks": [r.subsidy_part_kopecks for r in rows],
+        "limit_part_kopecks": [r.limit_part_kopecks for r in rows],
+        "items": [r.items for r in rows],
+    }
+    return pa.record_batch([pa.array(columns[f.name], type=f.type) for f in schema], schema=schema)
+
+class ChunkSink(io.RawIOBase):
+    # Файловый объект только на запись: накопленные байты забираются генератором после каждой пачки
+    def __init__(self):
+        self._chunks = []
+        self._pos = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        self._pos += len(b)
+        return len(b)
+
+    def tell(self):
+        return self._pos
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+def iter_export_columnar(start_date, end_date, fmt):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    schema = export_schema()
+    sink = ChunkSink()
+    # Каждая пачка курсора — отдельная row group (Parquet) или record batch (Arrow IPC)
+    if fmt == "parquet":
+        writer = pq.ParquetWriter(sink, schema, compression="zstd")
+    else:
+        writer = pa.ipc.new_stream(sink, schema)
+    try:
+        for rows in iter_batches(start_date, end_date, with_employee=True):
+            writer.write_batch(to_record_batch(rows, schema))
+            chunk = sink.drain()
+            if chunk:
+                yield chunk
+    finally:
+        writer.close()
+    yield sink.drain()
@@ -0,0 +1,27 @@
+import pickle
+import struct
+import numpy as np
+
+# Формат: заголовок 8 байт (magic, версия, тип, размерность) + сырые little-endian float32
+MAGIC = b"FE"
+FORMAT_VERSION = 1
+DTYPE_FLOAT32 = 1
+_HEADER = struct.Struct("<2sBBI")
+_DTYPES = {DTYPE_FLOAT32: np.dtype("<f4")}
+
+def encode_embedding(embedding):
+    vec = np.ascontiguousarray(embedding, dtype=_DTYPES[DTYPE_FLOAT32]).ravel()
+    return _HEADER.pack(MAGIC, FORMAT_VERSION, DTYPE_FLOAT32, vec.size) + vec.tobytes()
+
+def is_legacy(blob):
+    return bytes(blob[:2]) != MAGIC
+
+def decode_embedding(blob):
+    # Старые записи (pickle) читаем тоже, пока не прошла миграция
+    if is_legacy(blob):
+        return np.asarray(pickle.loads(blob), dtype=np.float32)
+    magic, version, dtype_code, dim = _HEADER.unpack_from(blob)
+    if version != FORMAT_VERSION or dtype_code not in _DTYPES:
+        raise ValueError(f"Unsupported embedding format v{version}, dtype {dtype_code}")
+    # frombuffer не копирует данные — массив смотрит прямо в байты из БД
+    return np.frombuffer(blob, dtype=_DTYPES[dtype_code], count=dim, offset=_HEADER.size)
@@ -0,0 +1,61 @@
+import os
+import math
+
+# Последовательный тест Вальда (SPRT) по расстояниям кадров до шаблона.
+# Расстояния dlib моделируем двумя нормальными распределениями: «тот же человек» и «другой».
+FACE_GENUINE_MEAN = float(os.getenv("FACE_GENUINE_MEAN", "0.42"))
+FACE_IMPOSTOR_MEAN = float(os.getenv("FACE_IMPOSTOR_MEAN", "0.78"))
+FACE_DISTANCE_SIGMA = float(os.getenv("FACE_DISTANCE_SIGMA", "0.1"))
+FACE_FALSE_ACCEPT = float(os.getenv("FACE_FALSE_ACCEPT", "0.001"))   # Допустимая вероятность пустить чужого
+FACE_FALSE_REJECT = float(os.getenv("FACE_FALSE_REJECT", "0.01"))    # Допустимая вероятность отказать своему
+FACE_REJECT_MIN_FRAMES = int(os.getenv("FACE_REJECT_MIN_FRAMES", "3"))
+# Вклад кадра ограничен несимметрично: один плохой кадр (голова повёрнута, лицо закрыто) не отклоняет сессию,
+# а один-два чётких кадра принимают её сразу. Потолок ниже порога 1:N-поиска — там нужно минимум два кадра
+FACE_FRAME_LLR_MIN = float(os.getenv("FACE_FRAME_LLR_MIN", "-3"))
+FACE_FRAME_LLR_MAX = float(os.getenv("FACE_FRAME_LLR_MAX", "10"))
+# Лицо держится у порога и улики не копятся — после стольких кадров решаем по среднему расстоянию, а не ждём TTL
+FACE_DECIDE_MAX_FRAMES = int(os.getenv("FACE_DECIDE_MAX_FRAMES", "8"))
+FACE_TOLERANCE = float(os.getenv("FACE_TOLERANCE", "0.6"))
+FACE_EVIDENCE_WINDOW = 10
+
+ACCEPT_LLR = math.log((1 - FACE_FALSE_REJECT) / FACE_FALSE_ACCEPT)
+REJECT_LLR = math.log(FACE_FALSE_REJECT / (1 - FACE_FALSE_ACCEPT))
+
+def identify_accept_llr(gallery_size):
+    # Сессия из 1:N-поиска: чужой может оказаться ближайшим к любому из N шаблонов,
+    # поэтому допустимую вероятность ложного допуска делим на N
+    return ACCEPT_LLR + math.log(max(1, gallery_size))
+
+def frame_llr(distance):
+    # log p(d | свой) - log p(d | чужой); положительное значение — в пользу совпадения
+    s2 = 2 * FACE_DISTANCE_SIGMA ** 2
+    llr = ((distance - FACE_IMPOSTOR_MEAN) ** 2 - (distance - FACE_GENUINE_MEAN) ** 2) / s2
+    return max(FACE_FRAME_LLR_MIN, min(FACE_FRAME_LLR_MAX, llr))
+
+def add_distance(sess, distance):
+    # Копит улики в состоянии сессии (только JSON-совместимые типы) и возвращает решение
+    distances = sess.setdefault("distances", [])
+    distances.append(round(float(distance), 4))
+    del distances[:-FACE_EVIDENCE_WINDOW]
+    sess["frames_with_face"] = sess.get("frames_with_face", 0) + 1
+    sess["llr"] = sess.get("llr", 0.0) + frame_llr(distance)
+    sess["min_distance"] = min(sess.get("min_distance", distance), distance)
+
+    if sess["llr"] >= sess.get("accept_llr", ACCEPT_LLR):
+        return "match"
+    if sess["llr"] <= REJECT_LLR and sess["frames_with_face"] >= FACE_REJECT_MIN_FRAMES:
+        return "no_match"
+    if sess["frames_with_face"] >= FACE_DECIDE_MAX_FRAMES:
+        # Сверка с картой — как 1:1-порог, но по среднему окна; сессию 1:N-поиска у порога не принимаем
+        mean = sum(distances) / len(distances)
+        return "match" if sess.get("budget_match", True) and mean <= FACE_TOLERANCE else "no_match"
+    return None
+
+def summary(sess):
+    distances = sess.get("distances") or []
+    return {
+        "distance": distances[-1] if distances else None,
+        "min_distance": sess.get("min_distance"),
+        "mean_distance": round(sum(distances) / len(distances), 4) if distances else None,
+        "evidence": round(sess.get("llr", 0.0), 2),
+    }
@@ -0,0 +1,37 @@
+import numpy as np
+
+# Грубый IVF-индекс: k-means по шаблонам, поиск только в n_probe ближайших кластерах
+class IVFIndex:
+    def __init__(self, n_lists=64, n_probe=8):
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.centroids = None
+        self.lists = []
+
+    def train(self, matrix, iterations=10, seed=0):
+        n_lists = max(1, min(self.n_lists, len(matrix)))
+        rng = np.random.default_rng(seed)
+        centroids = matrix[rng.choice(len(matrix), n_lists, replace=False)].copy()
+        for _ in range(iterations):
+            labels = self._nearest(matrix, centroids)
+            for c in range(n_lists):
+                members = matrix[labels == c]
+                if len(members): centroids[c] = members.mean(axis=0)
+        self.centroids = centroids
+        self.assign(matrix)
+
+    def assign(self, matrix):
+        # Центроиды переиспользуем, пересобираем только списки — это одна матричная операция
+        labels = self._nearest(matrix, self.centroids)
+        self.lists = [np.flatnonzero(labels == c) for c in range(len(self.centroids))]
+
+    def candidates(self, embedding):
+        dist = np.linalg.norm(self.centroids - embedding, axis=1)
+        probe = np.argsort(dist)[:self.n_probe]
+        return np.concatenate([self.lists[c] for c in probe])
+
+    @staticmethod
+    def _nearest(matrix, centroids):
+        # ||a-b||² = ||a||² - 2ab + ||b||², без построения тензора N x C x D
+        scores = (centroids * centroids).sum(axis=1) - 2.0 * matrix @ centroids.T
+        return np.argmin(scores, axis=1)
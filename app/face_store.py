@@ -0,0 +1,178 @@
+import os
+import time
+import threading
+import numpy as np
+from app.database import SessionLocal
+from app.models import Employee, Card
+from app.cache_versions import read_version
+from app.face_codec import decode_embedding
+from app.face_index import IVFIndex
+from app.cv_utils import face_distances
+
+# Как часто (сек) сверяем версию шаблонов в БД — изменения с других воркеров видны не позже этого
+FACE_STORE_CHECK_SEC = float(os.getenv("FACE_STORE_CHECK_SEC", "2"))
+FACE_VERSION_KEY = "face_templates"
+EMBEDDING_DIM = 128
+# IVF-индекс включается только на больших базах, для ~3 тыс. сотрудников полный перебор быстрее
+FACE_INDEX = os.getenv("FACE_INDEX", "flat")  # flat | ivf
+FACE_IVF_MIN_SIZE = int(os.getenv("FACE_IVF_MIN_SIZE", "20000"))
+FACE_IVF_LISTS = int(os.getenv("FACE_IVF_LISTS", "128"))
+FACE_IVF_PROBE = int(os.getenv("FACE_IVF_PROBE", "8"))
+
+# Все эмбеддинги в одной непрерывной float32-матрице, строка на сотрудника
+class FaceTemplateStore:
+    def __init__(self, dim=EMBEDDING_DIM):
+        self.dim = dim
+        self._lock = threading.RLock()
+        self._reset()
+        self._version = None
+        self._checked_at = 0.0
+
+    def _reset(self, capacity=0):
+        self._matrix = np.zeros((capacity, self.dim), dtype=np.float32)
+        self._emp_ids = np.zeros(capacity, dtype=np.int64)
+        self._size = 0
+        self._row_by_emp = {}
+        self._emp_by_uid = {}
+        self._uids_by_emp = {}
+        self._index = None
+        self._index_dirty = False
+
+    def _ensure_fresh(self):
+        now = time.monotonic()
+        if self._version is not None and now - self._checked_at < FACE_STORE_CHECK_SEC:
+            return
+        db = SessionLocal()
+        try:
+            version = read_version(db, FACE_VERSION_KEY)
+            if version != self._version:
+                self._load(db)
+                self._version = version
+        finally:
+            db.close()
+        self._checked_at = now
+
+    def _load(self, db):
+        rows = db.query(Employee.id, Employee.face_embedding, Card.uid).outerjoin(
+            Card, Card.employee_id == Employee.id
+        ).filter(Employee.face_embedding.isnot(None)).all()
+        self._reset(capacity=len(rows))
+        for emp_id, blob, uid in rows:
+            if emp_id not in self._row_by_emp:
+                self._put(emp_id, decode_embedding(blob))
+            if uid:
+                self._link(emp_id, uid)
+
+    def _put(self, emp_id, embedding):
+        row = self._row_by_emp.get(emp_id)
+        if row is None:
+            if self._size == len(self._matrix):
+                # Растим буфер удвоением, чтобы добавление было амортизированно O(1)
+                capacity = max(16, 2 * len(self._matrix))
+                matrix = np.zeros((capacity, self.dim), dtype=np.float32)
+                matrix[:self._size] = self._matrix[:self._size]
+                emp_ids = np.zeros(capacity, dtype=np.int64)
+                emp_ids[:self._size] = self._emp_ids[:self._size]
+                self._matrix, self._emp_ids = matrix, emp_ids
+            row = self._size
+            self._size += 1
+            self._row_by_emp[emp_id] = row
+            self._emp_ids[row] = emp_id
+        self._matrix[row] = np.asarray(embedding, dtype=np.float32)
+        self._index_dirty = True
+
+    def _link(self, emp_id, uid):
+        self._emp_by_uid[uid] = emp_id
+        self._uids_by_emp.setdefault(emp_id, set()).add(uid)
+
+    def _drop(self, emp_id):
+        row = self._row_by_emp.pop(emp_id, None)
+        for uid in self._uids_by_emp.pop(emp_id, ()):
+            self._emp_by_uid.pop(uid, None)
+        if row is None:
+            return
+        # Переносим последнюю строку на место удалённой, матрица остаётся плотной
+        last = self._size - 1
+        if row != last:
+            moved_emp = int(self._emp_ids[last])
+            self._matrix[row] = self._matrix[last]
+            self._emp_ids[row] = moved_emp
+            self._row_by_emp[moved_emp] = row
+        self._size = last
+        self._index_dirty = True
+
+    def _get_index(self):
+        if FACE_INDEX != "ivf" or self._size < FACE_IVF_MIN_SIZE:
+            return None
+        matrix = self._matrix[:self._size]
+        if self._index is None:
+            self._index = IVFIndex(n_lists=FACE_IVF_LISTS, n_probe=FACE_IVF_PROBE)
+            self._index.train(matrix)
+        elif self._index_dirty:
+            self._index.assign(matrix)
+        self._index_dirty = False
+        return self._index
+
+    def _accept_version(self, version):
+        # Если между нашей версией и новой никто ничего не менял — перезагрузка не нужна
+        if version is not None and self._version is not None and version == self._version + 1:
+            self._version = version
+
+    # --- Публичный API ---
+    def get_by_uid(self, card_uid):
+        with self._lock:
+            self._ensure_fresh()
+            emp_id = self._emp_by_uid.get(card_uid)
+            if emp_id is None:
+                return None
+            return emp_id, self._matrix[self._row_by_emp[emp_id]].copy()
+
+    def get_by_employee(self, emp_id):
+        with self._lock:
+            self._ensure_fresh()
+            row = self._row_by_emp.get(emp_id)
+            return None if row is None else self._matrix[row].copy()
+
+    def search(self, embedding, k=5):
+        # 1:N поиск: k ближайших шаблонов как [(employee_id, card_uid, distance)]
+        with self._lock:
+            self._ensure_fresh()
+            if self._size == 0:
+                return []
+            query = np.asarray(embedding, dtype=np.float32)
+            index = self._get_index()
+            rows = np.arange(self._size) if index is None else index.candidates(query)
+            if len(rows) == 0:
+                return []
+            known = self._matrix[:self._size] if index is None else self._matrix[rows]
+            dist = face_distances(known, query)
+            k = min(k, len(dist))
+            best = np.argpartition(dist, k - 1)[:k]
+            best = best[np.argsort(dist[best])]
+            result = []
+            for i in best:
+                emp_id = int(self._emp_ids[rows[i]])
+                uids = sorted(self._uids_by_emp.get(emp_id, ()))
+                result.append((emp_id, uids[0] if uids else None, float(dist[i])))
+            return result
+
+    def upsert(self, emp_id, card_uids, embedding, version=None):
+        with self._lock:
+            self._put(emp_id, embedding)
+            for uid in card_uids:
+                self._link(emp_id, uid)
+            self._accept_version(version)
+
+    def remove(self, emp_id, version=None):
+        with self._lock:
+            self._drop(emp_id)
+            self._accept_version(version)
+
+    def invalidate(self):
+        with self._lock:
+            self._version = None
+
+    def __len__(self):
+        return self._size
+
+FACE_STORE = FaceTemplateStore()
@@ -0,0 +1,129 @@
+from sqlalchemy import func, select, update, or_
+from sqlalchemy.dialects.postgresql import insert
+from app.models import DailySubsidyUsage, DailySales, Transaction, TransactionItem, Product, Employee
+
+# Запись оплаты и счётчики, которые обновляются в той же транзакции
+
+def _sales_key():
+    # Ключ сводки так же, как его считает пересборка: день по created_at, пустые касса/метод — значения по умолчанию
+    return (
+        func.date(Transaction.created_at).label("day"),
+        func.coalesce(Transaction.cash_desk_id, "unknown").label("cash_desk_id"),
+        func.coalesce(Transaction.payment_method, "internal").label("payment_method"),
+    )
+
+def record_transactions(db, rows):
+    # Одна многострочная вставка; строки с уже известным idempotency_key пропускаются.
+    # Возвращает только реально вставленные строки (id, idempotency_key, ключ сводки, сумма)
+    if not rows:
+        return []
+    stmt = insert(Transaction).values(rows).on_conflict_do_nothing(
+        index_elements=[Transaction.idempotency_key]
+    ).returning(Transaction.id, Transaction.idempotency_key, *_sales_key(), Transaction.amount_total_kopecks)
+    inserted = db.execute(stmt).all()
+    add_daily_sales(db, inserted)
+    # Позиции сопоставляем со вставленными строками по ключу (у одиночной вставки ключа может не быть)
+    by_key = {row.get("idempotency_key"): row for row in rows}
+    add_line_items(db, [(r.id, (rows[0] if len(rows) == 1 else by_key[r.idempotency_key]).get("items"))
+                        for r in inserted])
+    return inserted
+
+def add_line_items(db, tx_items):
+    # tx_items: [(transaction_id, items JSON — по элементу на единицу товара)] → строки transaction_items с qty
+    units = [(tx_id, i) for tx_id, items in tx_items for i in (items or [])]
+    if not units:
+        return
+    ids = {i["product_id"] for _, i in units if i.get("product_id") is not None}
+    names = {i["name"] for _, i in units if i.get("product_id") is None and i.get("name")}
+    # Один запрос на все товары чека: по id, а у старых касс без product_id — по названию
+    products = db.query(Product.id, Product.name, Product.category_id).filter(
+        or_(Product.id.in_(ids), Product.name.in_(names))
+    ).order_by(Product.id).all() if ids or names else []
+    by_id = {p.id: p for p in products}
+    by_name = {}
+    for p in products:
+        by_name.setdefault(p.name, p)
+
+    lines = {}
+    for tx_id, i in units:
+        product = by_id.get(i.get("product_id")) if i.get("product_id") is not None else by_name.get(i.get("name"))
+        key = (tx_id, product.id if product else None, i.get("name"), int(round((i.get("price") or 0) * 100)))
+        if key not in lines:
+            lines[key] = dict(transaction_id=tx_id, product_id=key[1], category_id=product.category_id if product else None,
+                              name=key[2], price_kopecks=key[3], qty=0)
+        lines[key]["qty"] += 1
+    db.execute(insert(TransactionItem).values(list(lines.values())))
+
+def add_daily_sales(db, rows):
+    totals = {}
+    for r in rows:
+        key = (r.day, r.cash_desk_id, r.payment_method)
+        amount, count = totals.get(key, (0, 0))
+        totals[key] = (amount + (r.amount_total_kopecks or 0), count + 1)
+    if not totals:
+        return
+    # Ключи по порядку: параллельные оплаты блокируют строки сводки в одной последовательности
+    stmt = insert(DailySales).values([
+        dict(day=day, cash_desk_id=desk, payment_method=method, amount_kopecks=amount, tx_count=count)
+        for (day, desk, method), (amount, count) in sorted(totals.items())
+    ])
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=[DailySales.day, DailySales.cash_desk_id, DailySales.payment_method],
+        set_={"amount_kopecks": DailySales.amount_kopecks + stmt.excluded.amount_kopecks,
+              "tx_count": DailySales.tx_count + stmt.excluded.tx_count},
+    ))
+
+def remove_daily_sales(db, *criteria):
+    # Вычитает из сводки транзакции, которые сейчас будут удалены — вызывать до DELETE
+    src = daily_sales_from_transactions().where(*criteria).subquery()
+    db.execute(update(DailySales).where(
+        DailySales.day == src.c.day, DailySales.cash_desk_id == src.c.cash_desk_id,
+        DailySales.payment_method == src.c.payment_method,
+    ).values(
+        amount_kopecks=DailySales.amount_kopecks - src.c.amount_kopecks,
+        tx_count=DailySales.tx_count - src.c.tx_count,
+    ).execution_options(synchronize_session=False))
+
+def consume_subsidy(db, employee_id, day, limit_kopecks, bill_kopecks):
+    # Атомарно забирает из дневной дотации сколько можно (не больше остатка и не больше чека).
+    # В SET Postgres видит старые значения строки, поэтому списанное = новое - старое считается без SELECT FOR UPDATE.
+    if limit_kopecks <= 0 or bill_kopecks <= 0:
+        return 0
+    first = min(limit_kopecks, bill_kopecks)
+    used = DailySubsidyUsage.used_kopecks
+    new_used = func.greatest(used, func.least(limit_kopecks, used + bill_kopecks))
+    stmt = insert(DailySubsidyUsage).values(
+        employee_id=employee_id, day=day, used_kopecks=first, last_applied_kopecks=first
+    ).on_conflict_do_update(
+        index_elements=[DailySubsidyUsage.employee_id, DailySubsidyUsage.day],
+        set_={"used_kopecks": new_used, "last_applied_kopecks": new_used - used},
+    ).returning(DailySubsidyUsage.last_applied_kopecks)
+    return int(db.execute(stmt).scalar())
+
+def debit_limit(db, employee_id, kopecks):
+    # Условное списание в целых копейках; None — средств не хватает (строка не обновлена)
+    balance_kop = func.round(Employee.month_limit_rub * 100)
+    stmt = update(Employee).where(Employee.id == employee_id, balance_kop >= kopecks).values(
+        month_limit_rub=(balance_kop - kopecks) / 100.0
+    ).returning(Employee.month_limit_rub).execution_options(synchronize_session=False)
+    return db.execute(stmt).scalar()
+
+def subsidy_usage_from_transactions(since=None):
+    # Эталон для сверки и пересборки: те же суммы, посчитанные по transactions
+    day = func.date(Transaction.created_at)
+    q = select(Transaction.employee_id, day.label("day"), func.sum(Transaction.subsidy_part_kopecks).label("used_kopecks")).where(
+        Transaction.employee_id.isnot(None), Transaction.subsidy_part_kopecks > 0
+    ).group_by(Transaction.employee_id, day)
+    if since is not None:
+        q = q.where(Transaction.created_at >= since)
+    return q
+
+def daily_sales_from_transactions(since=None):
+    # Эталон для сверки и пересборки daily_sales
+    day, desk, method = _sales_key()
+    q = select(day, desk, method,
+               func.sum(Transaction.amount_total_kopecks).label("amount_kopecks"),
+               func.count().label("tx_count")).group_by(day, desk, method)
+    if since is not None:
+        q = q.where(Transaction.created_at >= since)
+    return q
@@ -4,10 +4,13 @@ from dotenv import load_dotenv
 # ЭТО ДОЛЖНО БЫТЬ САМЫМ ПЕРВЫМ
 load_dotenv()
 
+import asyncio
 from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
 from app.database import engine, Base
 from app.routers import auth, payment, liveness, bot
+from app.cv_utils import CV_POOL
+from app.notifications import OUTBOX_WORKER
 
 Base.metadata.create_all(bind=engine)
 app = FastAPI(title="Cafeteria")
@@ -15,6 +18,13 @@ app = FastAPI(title="Cafeteria")
 @app.on_event("startup")
 async def startup_event():
     bot.start_bot()
+    asyncio.create_task(liveness.sweep_sessions_forever())
+    asyncio.create_task(OUTBOX_WORKER.run_forever())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    CV_POOL.shutdown()
+    OUTBOX_WORKER.shutdown()
 
 app.include_router(auth.router, prefix="/api")
 app.include_router(liveness.router, prefix="/api")
@@ -1,6 +1,6 @@
 from datetime import datetime
 from datetime import datetime
-from sqlalchemy import Column, JSON, Integer, String, Float, LargeBinary, ForeignKey, Date, DateTime
+from sqlalchemy import Column, JSON, Integer, BigInteger, String, Float, LargeBinary, ForeignKey, Date, DateTime
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from app.database import Base
@@ -19,7 +19,7 @@ class Card(Base):
     __tablename__ = "cards"
     id = Column(Integer, primary_key=True, index=True)
     uid = Column(String, unique=True, index=True)
-    employee_id = Column(Integer, ForeignKey("employees.id"))
+    employee_id = Column(Integer, ForeignKey("employees.id"), index=True)
 
 class Transaction(Base):
     __tablename__ = "transactions"
@@ -29,12 +29,14 @@ class Transaction(Base):
     subsidy_part_kopecks = Column(Integer)
     limit_part_kopecks = Column(Integer)
     status = Column(String)
-    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), index=True)
 
 
     cash_desk_id = Column(String, index=True, nullable=True)
     payment_method = Column(String, default="internal")
     items = Column(JSON, nullable=True)
+    # Ключ повтора от кассы: тот же ключ — та же оплата, второй раз не проводится
+    idempotency_key = Column(String, unique=True, index=True, nullable=True)
 class WorkDay(Base):
     __tablename__ = "work_days"
     id = Column(Integer, primary_key=True, index=True)
@@ -52,7 +54,9 @@ class LivenessSession(Base):
     __tablename__ = "liveness_sessions"
     id = Column(String, primary_key=True, index=True)
     card_uid = Column(String)
-    timestamp = Column(DateTime, default=datetime.now)
+    employee_id = Column(Integer, ForeignKey("employees.id"), nullable=True)
+    timestamp = Column(DateTime, default=datetime.now, index=True)
+    state = Column(JSON, nullable=True)
 
 
 class CashDesk(Base):
@@ -73,3 +77,50 @@ class Product(Base):
     name = Column(String)
     price = Column(Integer)
     category_id = Column(Integer, ForeignKey('categories.id'))
+
+class CacheVersion(Base):
+    __tablename__ = 'cache_versions'
+    name = Column(String, primary_key=True)
+    version = Column(Integer, default=0)
+
+class DailySubsidyUsage(Base):
+    __tablename__ = 'daily_subsidy_usage'
+    employee_id = Column(Integer, ForeignKey("employees.id"), primary_key=True)
+    day = Column(Date, primary_key=True)
+    used_kopecks = Column(Integer, default=0, nullable=False)
+    # Сколько списала последняя оплата — возвращается атомарным UPDATE ... RETURNING
+    last_applied_kopecks = Column(Integer, default=0, nullable=False)
+
+class Notification(Base):
+    # Исходящие сообщения в Telegram: пишутся в транзакции оплаты, отправляются фоновым воркером
+    __tablename__ = 'notification_outbox'
+    id = Column(Integer, primary_key=True, index=True)
+    kind = Column(String)  # message | report
+    chat_id = Column(String)
+    payload = Column(JSON)
+    status = Column(String, default="pending", index=True)  # pending | sent | failed
+    attempts = Column(Integer, default=0)
+    next_attempt_at = Column(DateTime, default=datetime.now, index=True)
+    last_error = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.now)
+
+class DailySales(Base):
+    # Сводка продаж по дням для графиков: обновляется вместе с каждой транзакцией (app/ledger.py)
+    __tablename__ = 'daily_sales'
+    day = Column(Date, primary_key=True)
+    cash_desk_id = Column(String, primary_key=True)
+    payment_method = Column(String, primary_key=True)
+    amount_kopecks = Column(BigInteger, default=0, nullable=False)
+    tx_count = Column(Integer, default=0, nullable=False)
+
+class TransactionItem(Base):
+    # Позиции чека строками (дублируют Transaction.items) — для отчётов по товарам.
+    # Название и категория — на момент продажи, товар мог быть потом переименован или удалён
+    __tablename__ = 'transaction_items'
+    id = Column(Integer, primary_key=True)
+    transaction_id = Column(Integer, ForeignKey("transactions.id"), index=True, nullable=False)
+    product_id = Column(Integer, index=True, nullable=True)
+    category_id = Column(Integer, index=True, nullable=True)
+    name = Column(String)
+    price_kopecks = Column(Integer)
+    qty = Column(Integer)
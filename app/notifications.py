@@ -0,0 +1,237 @@
+import os
+import time
+import json
+import random
+import asyncio
+from datetime import datetime, timedelta
+import requests
+from requests.adapters import HTTPAdapter
+from fastapi.concurrency import run_in_threadpool
+from app.database import SessionLocal
+from app.models import Notification
+
+TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+# Можно направить на локальный fake_telegram.py для проверки без настоящего бота
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org").rstrip("/")
+
+# --- Настройки outbox-воркера ---
+OUTBOX_POLL_SEC = float(os.getenv("OUTBOX_POLL_SEC", "1"))
+OUTBOX_BATCH = int(os.getenv("OUTBOX_BATCH", "20"))
+OUTBOX_CONCURRENCY = int(os.getenv("OUTBOX_CONCURRENCY", "4"))     # Одновременных запросов к Telegram
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_BACKOFF_SEC = float(os.getenv("OUTBOX_BACKOFF_SEC", "2"))
+OUTBOX_BACKOFF_MAX_SEC = float(os.getenv("OUTBOX_BACKOFF_MAX_SEC", "600"))
+OUTBOX_LEASE_SEC = int(os.getenv("OUTBOX_LEASE_SEC", "60"))        # Взятое воркером сообщение не видно другим столько секунд
+OUTBOX_KEEP_DAYS = int(os.getenv("OUTBOX_KEEP_DAYS", "7"))
+
+# --- Ограничения Telegram (на процесс) ---
+TG_RATE_PER_SEC = float(os.getenv("TG_RATE_PER_SEC", "25"))          # Всего у бота ~30 сообщений в секунду
+TG_CHAT_INTERVAL_SEC = float(os.getenv("TG_CHAT_INTERVAL_SEC", "1"))  # Не чаще раза в секунду в один чат
+TG_BREAKER_FAILURES = int(os.getenv("TG_BREAKER_FAILURES", "5"))
+TG_BREAKER_COOLDOWN_SEC = float(os.getenv("TG_BREAKER_COOLDOWN_SEC", "60"))
+TG_TIMEOUT = (3.05, 15)
+
+# --- Постановка в очередь (в той же транзакции, что и оплата) ---
+def enqueue_message(db, chat_id, text):
+    if not chat_id or not TELEGRAM_BOT_TOKEN: return
+    db.add(Notification(kind="message", chat_id=str(chat_id), payload={"text": text}))
+
+def enqueue_report(db, chat_id, db_photo_path, live_photo_path, caption):
+    # В очереди только пути к файлам: кадр уже лежит в хранилище аудита (app/audit_store.py)
+    if not chat_id or not TELEGRAM_BOT_TOKEN: return
+    db.add(Notification(kind="report", chat_id=str(chat_id), payload={
+        "caption": caption, "db_photo": db_photo_path, "live_photo_path": live_photo_path,
+    }))
+
+# --- Клиент Telegram ---
+class TelegramError(Exception):
+    def __init__(self, message, retry_after=None, permanent=False):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.permanent = permanent
+
+class TelegramClient:
+    def __init__(self, base_url=TELEGRAM_API_URL, token=TELEGRAM_BOT_TOKEN, pool_size=OUTBOX_CONCURRENCY):
+        self.base_url = f"{base_url}/bot{token}"
+        # Одна keep-alive сессия на процесс: TLS-рукопожатие не повторяется на каждое сообщение
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def call(self, method, **kwargs):
+        try:
+            r = self.session.post(f"{self.base_url}/{method}", timeout=TG_TIMEOUT, **kwargs)
+        except requests.RequestException as e:
+            raise TelegramError(f"{type(e).__name__}: {e}")
+        if r.status_code == 200:
+            return
+        try: body = r.json()
+        except ValueError: body = {}
+        description = body.get("description") or f"HTTP {r.status_code}"
+        if r.status_code == 429:
+            raise TelegramError(description, retry_after=body.get("parameters", {}).get("retry_after", 5))
+        # 4xx (чат не найден, бот заблокирован) повторять бессмысленно
+        raise TelegramError(description, permanent=400 <= r.status_code < 500)
+
+    def send(self, kind, chat_id, payload):
+        if kind == "message":
+            return self.call("sendMessage", json={"chat_id": chat_id, "text": payload["text"], "parse_mode": "HTML"})
+        try:
+            with open(payload["db_photo"], "rb") as f: db_bytes = f.read()
+            with open(payload["live_photo_path"], "rb") as f: live_bytes = f.read()
+        except (OSError, KeyError) as e:
+            raise TelegramError(f"Фото недоступно: {e}", permanent=True)
+        media = [{"type": "photo", "media": "attach://p1", "caption": payload["caption"], "parse_mode": "HTML"},
+                 {"type": "photo", "media": "attach://p2"}]
+        return self.call("sendMediaGroup", data={"chat_id": chat_id, "media": json.dumps(media)}, files={
+            "p1": ("1.jpg", db_bytes, "image/jpeg"), "p2": ("2.jpg", live_bytes, "image/jpeg"),
+        })
+
+    def close(self):
+        self.session.close()
+
+class RateLimiter:
+    # Равномерно раздаёт слоты: общий темп бота и минимальный интервал для каждого чата
+    def __init__(self, rate=TG_RATE_PER_SEC, chat_interval=TG_CHAT_INTERVAL_SEC):
+        self.interval = 1.0 / rate
+        self.chat_interval = chat_interval
+        self._next = 0.0
+        self._next_by_chat = {}
+
+    def reserve(self, chat_id):
+        now = time.monotonic()
+        at = max(now, self._next, self._next_by_chat.get(chat_id, 0.0))
+        self._next = at + self.interval
+        self._next_by_chat[chat_id] = at + self.chat_interval
+        if len(self._next_by_chat) > 1000:
+            self._next_by_chat = {k: v for k, v in self._next_by_chat.items() if v > now}
+        return at - now
+
+    def pause(self, seconds):
+        # 429 от Telegram: притормаживаем все отправки, а не только этот чат
+        self._next = max(self._next, time.monotonic() + seconds)
+
+class CircuitBreaker:
+    # После N сбоев подряд перестаём ходить в Telegram на cooldown, затем пробуем одним сообщением
+    def __init__(self, threshold=TG_BREAKER_FAILURES, cooldown=TG_BREAKER_COOLDOWN_SEC):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+
+    def capacity(self, n):
+        if self.opened_at is None:
+            return n
+        return 1 if time.monotonic() - self.opened_at >= self.cooldown else 0
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            if self.opened_at is None:
+                print(f"WARNING: Telegram API unavailable, pausing notifications for {self.cooldown:.0f}s")
+            self.opened_at = time.monotonic()
+
+# --- Работа с таблицей outbox ---
+def claim_due(limit):
+    # SKIP LOCKED: несколько воркеров uvicorn разбирают очередь, не мешая друг другу
+    db = SessionLocal()
+    try:
+        now = datetime.now()
+        rows = db.query(Notification).filter(
+            Notification.status == "pending", Notification.next_attempt_at <= now
+        ).order_by(Notification.next_attempt_at).limit(limit).with_for_update(skip_locked=True).all()
+        jobs = []
+        for r in rows:
+            r.attempts += 1
+            r.next_attempt_at = now + timedelta(seconds=OUTBOX_LEASE_SEC)
+            jobs.append({"id": r.id, "kind": r.kind, "chat_id": r.chat_id, "payload": r.payload, "attempts": r.attempts})
+        db.commit()
+        return jobs
+    finally:
+        db.close()
+
+def backoff_sec(attempts):
+    return min(OUTBOX_BACKOFF_MAX_SEC, OUTBOX_BACKOFF_SEC * 2 ** (attempts - 1)) * random.uniform(0.5, 1.0)
+
+def mark_done(job, error=None):
+    values = {"status": "sent", "last_error": None}
+    if error is not None:
+        if error.permanent or job["attempts"] >= OUTBOX_MAX_ATTEMPTS:
+            values = {"status": "failed"}
+        else:
+            delay = error.retry_after or backoff_sec(job["attempts"])
+            values = {"status": "pending", "next_attempt_at": datetime.now() + timedelta(seconds=delay)}
+        values["last_error"] = str(error)[:500]
+    db = SessionLocal()
+    try:
+        db.query(Notification).filter(Notification.id == job["id"]).update(values, synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+def prune_sent(days=OUTBOX_KEEP_DAYS):
+    db = SessionLocal()
+    try:
+        deleted = db.query(Notification).filter(
+            Notification.status == "sent", Notification.created_at < datetime.now() - timedelta(days=days)
+        ).delete(synchronize_session=False)
+        db.commit()
+        return deleted
+    finally:
+        db.close()
+
+class OutboxWorker:
+    def __init__(self):
+        self.client = None
+        self.limiter = RateLimiter()
+        self.breaker = CircuitBreaker()
+        self._sem = asyncio.Semaphore(OUTBOX_CONCURRENCY)
+        self._pruned_at = 0.0
+
+    async def run_forever(self):
+        if not TELEGRAM_BOT_TOKEN:
+            return
+        self.client = TelegramClient()
+        while True:
+            try:
+                if time.monotonic() - self._pruned_at > 3600:
+                    await run_in_threadpool(prune_sent)
+                    self._pruned_at = time.monotonic()
+                sent = await self._tick()
+            except Exception as e:
+                print(f"ERROR: Notification outbox failed: {e}")
+                sent = 0
+            if not sent:
+                await asyncio.sleep(OUTBOX_POLL_SEC)
+
+    async def _tick(self):
+        limit = self.breaker.capacity(OUTBOX_BATCH)
+        if not limit:
+            return 0
+        jobs = await run_in_threadpool(claim_due, limit)
+        await asyncio.gather(*(self._deliver(job) for job in jobs))
+        return len(jobs)
+
+    async def _deliver(self, job):
+        async with self._sem:
+            await asyncio.sleep(self.limiter.reserve(job["chat_id"]))
+            try:
+                await run_in_threadpool(self.client.send, job["kind"], job["chat_id"], job["payload"])
+            except TelegramError as e:
+                if e.retry_after: self.limiter.pause(e.retry_after)
+                elif not e.permanent: self.breaker.failure()
+                await run_in_threadpool(mark_done, job, e)
+                return
+            self.breaker.success()
+            await run_in_threadpool(mark_done, job)
+
+    def shutdown(self):
+        if self.client is not None:
+            self.client.close()
+
+OUTBOX_WORKER = OutboxWorker()
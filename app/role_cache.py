@@ -0,0 +1,42 @@
+import os
+import time
+import threading
+from app.models import RoleSetting
+from app.cache_versions import read_version
+
+# Настройки ролей меняются редко, а читаются на каждой оплате — держим их в памяти процесса
+ROLE_CACHE_CHECK_SEC = float(os.getenv("ROLE_CACHE_CHECK_SEC", "5"))
+ROLE_VERSION_KEY = "role_settings"
+
+class RoleSettingsCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subsidy = {}
+        self._version = None
+        self._checked_at = 0.0
+
+    def subsidy_rub(self, db, role_name):
+        # Запросы к БД — вне блокировки: при DB_ASYNC=1 они отдают управление event loop,
+        # и второй запрос, ждущий блокировку в том же потоке, повесил бы весь воркер
+        with self._lock:
+            now = time.monotonic()
+            known, subsidy = self._version, self._subsidy
+            fresh = known is not None and now - self._checked_at < ROLE_CACHE_CHECK_SEC
+        if fresh:
+            return subsidy.get(role_name)
+
+        version = read_version(db, ROLE_VERSION_KEY)
+        if version != known:
+            subsidy = dict(db.query(RoleSetting.role_name, RoleSetting.subsidy_rub).all())
+        with self._lock:
+            # Пока читали, кэш мог сбросить invalidate() — тогда не записываем поверх
+            if self._version == known:
+                self._subsidy, self._version = subsidy, version
+            self._checked_at = now
+        return subsidy.get(role_name)
+
+    def invalidate(self):
+        with self._lock:
+            self._version = None
+
+ROLE_CACHE = RoleSettingsCache()
@@ -1,10 +1,17 @@
-import os, pickle
-from fastapi import APIRouter, Depends, HTTPException, File, UploadFile, Form, Body
+import os, zipfile
+from fastapi import APIRouter, Depends, HTTPException, File, UploadFile, Form, Body, Query
 from sqlalchemy.orm import Session
-from sqlalchemy import func
-from app.database import get_db
-from app.models import Employee, Card, Transaction, WorkDay, RoleSetting
-from app.cv_utils import get_face_embedding
+from sqlalchemy import func, and_, or_, select
+from app.database import get_db, get_async_db, run_db
+from app.models import Employee, Card, Transaction, WorkDay, RoleSetting, LivenessSession, DailySubsidyUsage, TransactionItem
+from fastapi.concurrency import run_in_threadpool
+from app.cv_utils import get_face_embedding_async, CVPoolBusy
+from app.face_store import FACE_STORE, FACE_VERSION_KEY
+from app.cache_versions import bump_version
+from app.role_cache import ROLE_CACHE, ROLE_VERSION_KEY
+from app.ledger import remove_daily_sales
+from app.bulk_enroll import (save_enrollments, enroll_photos_async, iter_photos, summarize, spool_upload,
+                              ArchiveTooLarge, BULK_ENROLL_MAX_FILES, BULK_ENROLL_MAX_PHOTO_BYTES)
 from pydantic import BaseModel
 from datetime import date, timedelta
 from typing import List, Optional
@@ -12,6 +19,7 @@ from dotenv import load_dotenv
 
 router = APIRouter()
 PHOTOS_DIR = "/app/static/photos"
+EMPLOYEE_SORTS = {"name": Employee.full_name, "role": Employee.role, "limit": Employee.month_limit_rub, "id": Employee.id}
 
 class LoginRequest(BaseModel):
     password: str
@@ -54,21 +62,41 @@ async def login(data: LoginRequest = Body(...)):
 
 # --- СОТРУДНИКИ ---
 @router.get("/employees")
-def list_employees(db: Session = Depends(get_db)):
-    emps = db.query(Employee).all()
-    results = []
-    for e in emps:
-        card = db.query(Card).filter(Card.employee_id == e.id).first()
-        used_today_kop = db.query(func.sum(Transaction.subsidy_part_kopecks)).filter(
-            Transaction.employee_id == e.id, func.date(Transaction.created_at) == date.today()
-        ).scalar() or 0
-        results.append({
-            "id": e.id, "full_name": e.full_name, "role": e.role,
-            "month_limit_rub": e.month_limit_rub, "daily_used": used_today_kop / 100,
-            "has_face": e.face_embedding is not None, "card_uid": card.uid if card else "N/A",
-            "telegram_id": e.telegram_id
-        })
-    return results
+def list_employees(q: Optional[str] = None, sort: str = "name", desc: bool = False,
+                   limit: int = Query(50, ge=1, le=500), offset: int = Query(0, ge=0),
+                   db: Session = Depends(get_db)):
+    # Одна страница одним запросом: карта, потраченная сегодня дотация (из daily_subsidy_usage) и общее число строк
+    today = date.today()
+    card = select(Card.employee_id, func.min(Card.uid).label("uid")).group_by(Card.employee_id).subquery()
+    used_kop = func.coalesce(DailySubsidyUsage.used_kopecks, 0)
+    query = db.query(
+        Employee.id, Employee.full_name, Employee.role, Employee.month_limit_rub, Employee.telegram_id,
+        Employee.face_embedding.isnot(None).label("has_face"), card.c.uid, used_kop.label("used_kop"),
+        func.count().over().label("total"),
+    ).outerjoin(card, card.c.employee_id == Employee.id).outerjoin(
+        DailySubsidyUsage, and_(DailySubsidyUsage.employee_id == Employee.id, DailySubsidyUsage.day == today)
+    )
+    if q and q.strip():
+        # Имя — по вхождению (триграммный индекс), карта — по началу UID (индекс text_pattern_ops)
+        term = q.strip()
+        query = query.filter(or_(
+            Employee.full_name.ilike(f"%{term}%"),
+            Employee.id.in_(select(Card.employee_id).where(Card.uid.startswith(term, autoescape=True))),
+        ))
+    sort_col = EMPLOYEE_SORTS.get(sort, Employee.full_name) if sort != "daily_used" else used_kop
+    query = query.order_by(sort_col.desc() if desc else sort_col.asc(), Employee.id)
+    rows = query.limit(limit).offset(offset).all()
+    return {
+        "items": [{
+            "id": r.id, "full_name": r.full_name, "role": r.role,
+            "month_limit_rub": r.month_limit_rub, "daily_used": r.used_kop / 100,
+            "has_face": r.has_face, "card_uid": r.uid or "N/A",
+            "telegram_id": r.telegram_id
+        } for r in rows],
+        "total": rows[0].total if rows else 0,
+        "limit": limit,
+        "offset": offset,
+    }
 
 @router.post("/employees")
 def create_employee(data: EmployeeCreate, db: Session = Depends(get_db)):
@@ -83,16 +111,30 @@ def update_employee(emp_id: int, data: EmployeeUpdate, db: Session = Depends(get
     if not emp: raise HTTPException(404, "Not found")
     emp.full_name, emp.role, emp.month_limit_rub, emp.telegram_id = data.full_name, data.role, data.month_limit_rub, data.telegram_id
     card = db.query(Card).filter(Card.employee_id == emp_id).first()
-    if card: card.uid = data.card_uid.strip()
-    db.commit(); return {"status": "success"}
+    uid_changed = card is not None and card.uid != data.card_uid.strip()
+    if uid_changed:
+        card.uid = data.card_uid.strip()
+        bump_version(db, FACE_VERSION_KEY)
+    db.commit()
+    if uid_changed: FACE_STORE.invalidate()
+    return {"status": "success"}
 
 @router.delete("/employees/{emp_id}")
 def delete_employee(emp_id: int, db: Session = Depends(get_db)):
+    remove_daily_sales(db, Transaction.employee_id == emp_id)
+    db.query(TransactionItem).filter(TransactionItem.transaction_id.in_(
+        select(Transaction.id).where(Transaction.employee_id == emp_id)
+    )).delete(synchronize_session=False)
     db.query(Transaction).filter(Transaction.employee_id == emp_id).delete()
     db.query(Card).filter(Card.employee_id == emp_id).delete()
     db.query(WorkDay).filter(WorkDay.employee_id == emp_id).delete()
+    db.query(LivenessSession).filter(LivenessSession.employee_id == emp_id).delete()
+    db.query(DailySubsidyUsage).filter(DailySubsidyUsage.employee_id == emp_id).delete()
     db.query(Employee).filter(Employee.id == emp_id).delete()
-    db.commit(); return {"status": "success"}
+    version = bump_version(db, FACE_VERSION_KEY)
+    db.commit()
+    FACE_STORE.remove(emp_id, version=version)
+    return {"status": "success"}
 
 # --- РОЛИ ---
 @router.post("/role_settings")
@@ -100,7 +142,9 @@ def add_role(data: RoleUpdate, db: Session = Depends(get_db)):
     if db.query(RoleSetting).filter(RoleSetting.role_name == data.role_name).first():
         raise HTTPException(400, "Role exists")
     db.add(RoleSetting(role_name=data.role_name, subsidy_rub=data.subsidy_rub))
-    db.commit(); return {"status": "success"}
+    bump_version(db, ROLE_VERSION_KEY)
+    db.commit(); ROLE_CACHE.invalidate()
+    return {"status": "success"}
 
 @router.get("/role_settings")
 def get_role_settings(db: Session = Depends(get_db)):
@@ -109,7 +153,10 @@ def get_role_settings(db: Session = Depends(get_db)):
 @router.put("/role_settings")
 def update_role_setting(data: RoleUpdate, db: Session = Depends(get_db)):
     setting = db.query(RoleSetting).filter(RoleSetting.role_name == data.role_name).first()
-    if setting: setting.subsidy_rub = data.subsidy_rub; db.commit()
+    if setting:
+        setting.subsidy_rub = data.subsidy_rub
+        bump_version(db, ROLE_VERSION_KEY)
+        db.commit(); ROLE_CACHE.invalidate()
     return {"status": "success"}
 
 @router.delete("/role_settings/{role_name}")
@@ -117,7 +164,9 @@ def delete_role(role_name: str, db: Session = Depends(get_db)):
     role = db.query(RoleSetting).filter(RoleSetting.role_name == role_name).first()
     if not role: raise HTTPException(404, "Role not found")
     db.delete(role)
-    db.commit(); return {"status": "success"}
+    bump_version(db, ROLE_VERSION_KEY)
+    db.commit(); ROLE_CACHE.invalidate()
+    return {"status": "success"}
 
 # --- ГЛОБАЛЬНОЕ УПРАВЛЕНИЕ ДНЯМИ ---
 @router.post("/schedule/global_action")
@@ -164,18 +213,42 @@ def get_schedule(emp_id: int, db: Session = Depends(get_db)):
 @router.post("/enroll_face")
 async def enroll_face(card_uid: str = Form(...), file: UploadFile = File(...), db: Session = Depends(get_db)):
     content = await file.read()
-    os.makedirs(PHOTOS_DIR, exist_ok=True)
-    with open(os.path.join(PHOTOS_DIR, f"{card_uid.strip()}.jpg"), "wb") as f: f.write(content)
-    emb = get_face_embedding(content)
+    try:
+        # Ключ на карту: одновременные загрузки разных админов не вытесняют друг друга в очереди CV_POOL
+        emb = await get_face_embedding_async(content, key=f"enroll:{card_uid.strip()}")
+    except CVPoolBusy:
+        raise HTTPException(503, "Сервер распознавания занят, повторите через несколько секунд", headers={"Retry-After": "5"})
     if emb is None: raise HTTPException(400, "No face")
-    card = db.query(Card).filter(Card.uid == card_uid.strip()).first()
-    emp = db.query(Employee).filter(Employee.id == card.employee_id).first()
-    emp.face_embedding = pickle.dumps(emb); db.commit()
+    # Запись фото и коммит — в пуле потоков, чтобы не блокировать event loop
+    statuses = await run_in_threadpool(save_enrollments, db, [(card_uid.strip(), content, emb)], PHOTOS_DIR)
+    if statuses[card_uid.strip()] != "ok": raise HTTPException(404, "Card not found")
     return {"status": "success"}
 
+@router.post("/enroll_faces_bulk")
+async def enroll_faces_bulk(file: UploadFile = File(...), db: Session = Depends(get_db)):
+    # ZIP с файлами <card_uid>.jpg; возвращает отчёт по каждому файлу
+    try:
+        archive = await run_in_threadpool(spool_upload, file.file)
+    except ArchiveTooLarge as e:
+        raise HTTPException(413, str(e))
+    try:
+        photos = iter_photos(archive, max_files=BULK_ENROLL_MAX_FILES, max_photo_bytes=BULK_ENROLL_MAX_PHOTO_BYTES)
+        report = await enroll_photos_async(db, photos, PHOTOS_DIR)
+    except zipfile.BadZipFile:
+        raise HTTPException(400, "Not a ZIP archive")
+    except ArchiveTooLarge as e:
+        raise HTTPException(413, str(e))
+    finally:
+        archive.close()
+    return summarize(report)
+
+def employee_info(db, card_uid):
+    row = db.query(Employee.full_name, Employee.role, Employee.face_embedding.isnot(None)).join(
+        Card, Card.employee_id == Employee.id
+    ).filter(Card.uid == card_uid.strip()).first()
+    if not row: raise HTTPException(404, "Not found")
+    return {"name": row[0], "role": row[1], "has_face": row[2]}
+
 @router.get("/employee_info")
-def get_info(card_uid: str, db: Session = Depends(get_db)):
-    card = db.query(Card).filter(Card.uid == card_uid.strip()).first()
-    if not card: raise HTTPException(404, "Not found")
-    emp = db.query(Employee).filter(Employee.id == card.employee_id).first()
-    return {"name": emp.full_name, "role": emp.role, "has_face": emp.face_embedding is not None}
+async def get_info(card_uid: str, db=Depends(get_async_db)):
+    return await run_db(db, employee_info, card_uid)
@@ -1,16 +1,17 @@
 import os, time as time_module, json, urllib.request, threading, sys
 from sqlalchemy.orm import Session
-from sqlalchemy import func
 from app.database import SessionLocal
-from app.models import Employee, Transaction, WorkDay, RoleSetting
-from datetime import datetime, time, date # Импортируем классы времени
+from app.models import Employee, WorkDay, DailySubsidyUsage
+from app.role_cache import ROLE_CACHE
+from datetime import time, date # Импортируем классы времени
 
 # Загружаем токен сразу при импорте модуля
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org").rstrip("/")
 
 def send_reply(chat_id, text):
     if not TELEGRAM_BOT_TOKEN: return
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
+    url = f"{TELEGRAM_API_URL}/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
     data = json.dumps({"chat_id": chat_id, "text": text, "parse_mode": "HTML"}).encode('utf-8')
     req = urllib.request.Request(url, data=data, headers={'Content-Type': 'application/json'})
     try: urllib.request.urlopen(req, timeout=5)
@@ -27,14 +28,12 @@ def process_message(db, chat_id, text):
             return
             
         is_work_day = db.query(WorkDay).filter(WorkDay.employee_id == emp.id, WorkDay.date == date.today()).first() is not None
-        role_set = db.query(RoleSetting).filter(RoleSetting.role_name == emp.role).first()
-        daily_limit = role_set.subsidy_rub if (role_set and is_work_day) else 0
+        role_subsidy_rub = ROLE_CACHE.subsidy_rub(db, emp.role)
+        daily_limit = role_subsidy_rub if (role_subsidy_rub and is_work_day) else 0
         
-        # --- ФИКС: Считаем потраченное строго с начала текущих суток ---
-        start_of_today = datetime.combine(date.today(), time.min)
-        used_today_kop = db.query(func.sum(Transaction.subsidy_part_kopecks)).filter(
-            Transaction.employee_id == emp.id, 
-            Transaction.created_at >= start_of_today
+        # Потраченное за сегодня — из дневного счётчика, без суммирования транзакций
+        used_today_kop = db.query(DailySubsidyUsage.used_kopecks).filter(
+            DailySubsidyUsage.employee_id == emp.id, DailySubsidyUsage.day == date.today()
         ).scalar() or 0
         
         used_today_rub = used_today_kop / 100
@@ -59,7 +58,7 @@ def bot_polling():
     print(f"--- BOT POLLING STARTED WITH TOKEN: {token[:10]}... ---", file=sys.stderr)
     while True:
         try:
-            url = f"https://api.telegram.org/bot{token}/getUpdates?offset={offset}&timeout=30"
+            url = f"{TELEGRAM_API_URL}/bot{token}/getUpdates?offset={offset}&timeout=30"
             with urllib.request.urlopen(url, timeout=35) as response:
                 data = json.loads(response.read().decode())
                 for update in data.get("result", []):
@@ -1,35 +1,95 @@
-from fastapi import APIRouter, File, UploadFile, HTTPException, Form
+import os
+import asyncio
+from fastapi import APIRouter, Depends, File, UploadFile, HTTPException, Form, WebSocket, WebSocketDisconnect
+from fastapi.concurrency import run_in_threadpool
 import uuid
-import pickle
-from datetime import datetime
-from app.cv_utils import get_face_embedding, compare_faces
-from app.database import SessionLocal
-from app.models import Employee, Card, LivenessSession  # Добавили LivenessSession
+import numpy as np
+from datetime import datetime, date
+from sqlalchemy import func, and_
+from app.cv_utils import process_frame_async, face_distances, CVPoolBusy, CV_POOL
+from app import face_evidence
+from app.database import SessionLocal, get_async_db, run_db
+from app.models import LivenessSession, Employee, Card, WorkDay, RoleSetting, DailySubsidyUsage
+from app.face_codec import decode_embedding
+from app.face_store import FACE_STORE
+from app.session_store import SESSION_STORE, LIVENESS_SWEEP_SEC, sweep_db_sessions
 
 router = APIRouter()
 
-# Оставляем словарь для обработки кадров (чтобы не менять структуру БД прямо сейчас)
-LIVENESS_SESSIONS = {}
+# 1:N-поиск: порог строже, чем при сверке с картой (1:1) — вероятность найти похожего растёт с числом сотрудников.
+# И насколько лучший кандидат должен опережать второго, чтобы поиск считался однозначным
+FACE_IDENTIFY_TOLERANCE = float(os.getenv("FACE_IDENTIFY_TOLERANCE", "0.4"))
+FACE_IDENTIFY_MARGIN = float(os.getenv("FACE_IDENTIFY_MARGIN", "0.06"))
 
-@router.post("/start_liveness")
-def start_liveness(card_uid: str):
+# Подсказка кассе, через сколько слать следующий кадр: растёт под нагрузкой, падает в простое
+LIVENESS_FRAME_MIN_MS = int(os.getenv("LIVENESS_FRAME_MIN_MS", "150"))
+LIVENESS_FRAME_BASE_MS = int(os.getenv("LIVENESS_FRAME_BASE_MS", "600"))
+LIVENESS_FRAME_MAX_MS = int(os.getenv("LIVENESS_FRAME_MAX_MS", "2000"))
+
+def next_frame_hint():
+    load = CV_POOL.load()
+    if load <= 1:
+        ms = LIVENESS_FRAME_MIN_MS + (LIVENESS_FRAME_BASE_MS - LIVENESS_FRAME_MIN_MS) * load
+    else:
+        ms = LIVENESS_FRAME_BASE_MS + (LIVENESS_FRAME_MAX_MS - LIVENESS_FRAME_BASE_MS) * (load - 1) / 2
+    return int(min(ms, LIVENESS_FRAME_MAX_MS))
+
+# Не больше одного кадра сессии в обработке; новый ожидающий кадр вытесняет старый
+class FrameGate:
+    def __init__(self):
+        self._slots = {}  # sid -> {"waiting": future | None}
+
+    async def acquire(self, sid):
+        slot = self._slots.get(sid)
+        if slot is None:
+            self._slots[sid] = {"waiting": None}
+            return True
+        if slot["waiting"] is not None and not slot["waiting"].done():
+            slot["waiting"].set_result(False)
+        fut = asyncio.get_running_loop().create_future()
+        slot["waiting"] = fut
+        try:
+            return await fut
+        except asyncio.CancelledError:
+            # Слот уже передали нам, но клиент ушёл — отдаём дальше
+            if fut.done() and not fut.cancelled() and fut.result():
+                self.release(sid)
+            raise
+
+    def release(self, sid):
+        slot = self._slots.get(sid)
+        if slot is None:
+            return
+        waiting, slot["waiting"] = slot["waiting"], None
+        if waiting is not None and not waiting.done():
+            waiting.set_result(True)
+        else:
+            del self._slots[sid]
+
+FRAME_GATE = FrameGate()
+
+def create_session(card_uid, passed=False, employee_id=None, context=None, db=None):
     session_id = str(uuid.uuid4())
-    
-    # 1. Сохраняем в память (для работы проверки лица)
-    LIVENESS_SESSIONS[session_id] = {
+
+    state = {
         "uid": card_uid.strip(),
-        "passed": False,
-        "frames_processed": 0
+        "passed": passed,
+        "frames_processed": 0,
+        "box": None,  # Рамка лица с прошлого кадра — область поиска для следующего
+        "employee_id": employee_id,
+        **(context or {})
     }
 
-    # 2. ФИКС: Сохраняем в Базу Данных (чтобы оплата увидела сессию)
-    db = SessionLocal()
+    # Запись в БД нужна payment.py; при LIVENESS_STORE=db в ней же живёт состояние проверки
+    own_db = db is None
+    db = db or SessionLocal()
     try:
-        # Создаем запись, которую ждет payment.py
         db_session = LivenessSession(
             id=session_id,
             card_uid=card_uid.strip(),
-            timestamp=datetime.now()
+            employee_id=employee_id,
+            timestamp=datetime.now(),
+            state=state
         )
         db.add(db_session)
         db.commit()
@@ -39,42 +99,216 @@ def start_liveness(card_uid: str):
         db.rollback()
         raise HTTPException(status_code=500, detail="Database error")
     finally:
-        db.close()
+        if own_db: db.close()
 
-    return {"session_id": session_id}
+    SESSION_STORE.create(session_id, state)
+    return session_id
 
-@router.post("/liveness_frame")
-async def liveness_frame(session_id: str = Form(...), file: UploadFile = File(...)):
-    # Проверка в памяти работает быстрее для потока видео
-    if session_id not in LIVENESS_SESSIONS:
-        raise HTTPException(status_code=404, detail="Session not found in RAM")
+async def _store_call(fn, *args):
+    # Общее хранилище ходит в БД — уводим вызов с event loop
+    return await run_in_threadpool(fn, *args) if SESSION_STORE.blocking else fn(*args)
+
+async def sweep_sessions_forever():
+    while True:
+        await asyncio.sleep(LIVENESS_SWEEP_SEC)
+        try:
+            SESSION_STORE.sweep()
+            await run_in_threadpool(sweep_db_sessions)
+        except Exception as e:
+            print(f"ERROR: Liveness session sweep failed: {e}")
+
+@router.post("/start_liveness")
+def start_liveness(card_uid: str):
+    return {"session_id": create_session(card_uid)}
+
+@router.post("/checkout/start")
+async def checkout_start(card_uid: str, db=Depends(get_async_db)):
+    return await run_db(db, start_checkout, card_uid)
+
+def start_checkout(db, card_uid):
+    # Одним запросом: карта, сотрудник, рабочий ли сегодня день, дотация роли и потраченное за сегодня
+    card_uid = card_uid.strip()
+    today = date.today()
+    row = db.query(
+        Employee, WorkDay.id.isnot(None).label("is_work_day"), RoleSetting.subsidy_rub,
+        func.coalesce(DailySubsidyUsage.used_kopecks, 0).label("used_kop")
+    ).select_from(Card).join(Employee, Employee.id == Card.employee_id).outerjoin(
+        WorkDay, and_(WorkDay.employee_id == Employee.id, WorkDay.date == today)
+    ).outerjoin(RoleSetting, RoleSetting.role_name == Employee.role).outerjoin(
+        DailySubsidyUsage, and_(DailySubsidyUsage.employee_id == Employee.id, DailySubsidyUsage.day == today)
+    ).filter(Card.uid == card_uid).first()
+    if not row: raise HTTPException(404, "Not found")
+    emp, is_work_day, subsidy_rub, used_kop = row
+
+    # create_session делает commit, после которого emp истекает — поля берём заранее, иначе будет второй SELECT
+    emp_id, emp_name, emp_role, month_limit_rub = emp.id, emp.full_name, emp.role, emp.month_limit_rub
+
+    subsidy_kop = int(round((subsidy_rub or 0) * 100)) if is_work_day else 0
+    # Шаблон лица кладём прямо в сессию — кадры сверяются с ним без обращения к БД
+    template = decode_embedding(emp.face_embedding).tolist() if emp.face_embedding else None
+    session_id = create_session(card_uid, employee_id=emp_id, db=db, context={
+        "template": template, "subsidy_kop": subsidy_kop, "used_today_kop": int(used_kop)
+    })
+    return {
+        "session_id": session_id,
+        "name": emp_name,
+        "role": emp_role,
+        "has_face": template is not None,
+        "photo_url": f"static/photos/{card_uid}.jpg",
+        "month_limit_rub": round(month_limit_rub, 2),
+        "subsidy_rub": subsidy_kop / 100,
+        "subsidy_left_rub": max(0, subsidy_kop - int(used_kop)) / 100,
+    }
+
+async def handle_frame(session_id, content, cash_desk_id=None):
+    sess = await _store_call(SESSION_STORE.get, session_id)
+    if sess is None:
+        raise HTTPException(status_code=404, detail="Session not found or expired")
 
-    sess = LIVENESS_SESSIONS[session_id]
-    
     # Если лицо уже подтверждено, не грузим БД лишний раз
     if sess["passed"]:
         return {"status": "finished"}
+    if sess.get("rejected"):
+        return {"status": "rejected", **face_evidence.summary(sess)}
+
+    # Шаблон лица берём из сессии или из памяти процесса: без запросов к БД и без pickle на каждый кадр
+    if sess.get("template") is not None:
+        target_embedding = np.asarray(sess["template"], dtype=np.float32)
+    else:
+        template = await run_in_threadpool(FACE_STORE.get_by_uid, sess["uid"])
+        if template is None:
+            raise HTTPException(status_code=400, detail="No face enrolled")
+        _, target_embedding = template
 
-    db = SessionLocal()
     try:
-        card = db.query(Card).filter(Card.uid == sess["uid"]).first()
-        if not card:
-            raise HTTPException(status_code=404, detail="Card not found in DB")
+        # Кадр считается в пуле CV-воркеров, event loop не блокируется
+        frame = await process_frame_async(content, key=cash_desk_id or session_id, roi=sess["box"])
+    except CVPoolBusy:
+        return {"status": "busy"}
 
-        emp = db.query(Employee).filter(Employee.id == card.employee_id).first()
-        if not emp or not emp.face_embedding:
-            raise HTTPException(status_code=400, detail="No face enrolled")
+    sess["box"] = frame["box"]
+    sess["frames_processed"] += 1
+    status = "processing"
+    if frame["embedding"] is not None:
+        # Решение принимаем по сумме улик со всех кадров, а не по одному кадру
+        distance = float(face_distances(target_embedding[None, :], frame["embedding"])[0])
+        decision = face_evidence.add_distance(sess, distance)
+        if decision == "match":
+            sess["passed"], status = True, "finished"
+        elif decision == "no_match":
+            sess["rejected"], status = True, "rejected"
+    await _store_call(SESSION_STORE.save, session_id, sess)
+    # reason подсказывает кассе, почему кадр отброшен (размыт, темно, лицо мелкое и т.д.)
+    return {"status": status, "reason": frame["reason"], "timings": frame["timings"], **face_evidence.summary(sess)}
+
+@router.post("/liveness_frame")
+async def liveness_frame(session_id: str = Form(...), file: UploadFile = File(...), cash_desk_id: str = Form(None)):
+    content = await file.read()
+    if not await FRAME_GATE.acquire(session_id):
+        return {"status": "superseded", "next_frame_after_ms": next_frame_hint()}
+    try:
+        result = await handle_frame(session_id, content, cash_desk_id)
+    finally:
+        FRAME_GATE.release(session_id)
+    result["next_frame_after_ms"] = next_frame_hint()
+    return result
 
-        content = await file.read()
-        frame_embedding = get_face_embedding(content)
+@router.websocket("/liveness_ws/{session_id}")
+async def liveness_ws(websocket: WebSocket, session_id: str, cash_desk_id: str = None):
+    # Касса шлёт бинарные JPEG-кадры; пока воркер занят, в обработку попадает только самый свежий
+    await websocket.accept()
+    latest = {"frame": None, "dropped": 0, "closed": False}
+    ready = asyncio.Event()
 
-        if frame_embedding is not None:
-            target_embedding = pickle.loads(emp.face_embedding)
-            if compare_faces(target_embedding, frame_embedding):
-                sess["passed"] = True
-                return {"status": "finished"}
+    async def receive_frames():
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                latest["closed"] = True
+                ready.set()
+                return
+            frame = message.get("bytes")
+            if not frame:
+                continue
+            if latest["frame"] is not None:
+                latest["dropped"] += 1
+            latest["frame"] = frame
+            ready.set()
 
-        sess["frames_processed"] += 1
-        return {"status": "processing"}
+    receiver = asyncio.create_task(receive_frames())
+    try:
+        while True:
+            await ready.wait()
+            ready.clear()
+            if latest["closed"]:
+                break
+            frame, latest["frame"] = latest["frame"], None
+            if frame is None:
+                continue
+            if not await FRAME_GATE.acquire(session_id):
+                continue
+            try:
+                result = await handle_frame(session_id, frame, cash_desk_id)
+            except HTTPException as e:
+                await websocket.send_json({"status": "error", "detail": e.detail})
+                break
+            finally:
+                FRAME_GATE.release(session_id)
+            result["dropped"] = latest["dropped"]
+            result["next_frame_after_ms"] = next_frame_hint()
+            await websocket.send_json(result)
+            if result["status"] in ("finished", "rejected"):
+                break
+    except (WebSocketDisconnect, RuntimeError):
+        pass
+    finally:
+        receiver.cancel()
+        if not latest["closed"]:
+            try: await websocket.close()
+            except RuntimeError: pass
+
+# --- 1:N ИДЕНТИФИКАЦИЯ (без карты) ---
+def _employee_names(emp_ids):
+    db = SessionLocal()
+    try:
+        return dict(db.query(Employee.id, Employee.full_name).filter(Employee.id.in_(emp_ids)).all())
     finally:
         db.close()
+
+@router.post("/identify_face")
+async def identify_face(file: UploadFile = File(...), top_k: int = Form(5), cash_desk_id: str = Form(None)):
+    content = await file.read()
+    try:
+        frame = await process_frame_async(content, key=cash_desk_id or "identify")
+    except CVPoolBusy:
+        return {"status": "busy", "candidates": []}
+    frame_embedding = frame["embedding"]
+    if frame_embedding is None:
+        return {"status": "no_face", "candidates": []}
+
+    matches = await run_in_threadpool(FACE_STORE.search, frame_embedding, max(1, min(top_k, 20)))
+    names = await run_in_threadpool(_employee_names, [m[0] for m in matches]) if matches else {}
+    # Номер карты — платёжный идентификатор, анонимному вызывающему его не отдаём
+    candidates = [
+        {"employee_id": emp_id, "name": names.get(emp_id), "distance": round(dist, 4)}
+        for emp_id, _, dist in matches
+    ]
+
+    confident = (
+        bool(matches) and matches[0][1] is not None
+        and matches[0][2] <= FACE_IDENTIFY_TOLERANCE
+        and (len(matches) == 1 or matches[1][2] - matches[0][2] >= FACE_IDENTIFY_MARGIN)
+    )
+    if not confident:
+        return {"status": "ambiguous" if candidates else "not_found", "candidates": candidates}
+    template = await run_in_threadpool(FACE_STORE.get_by_employee, matches[0][0])
+    if template is None:
+        return {"status": "not_found", "candidates": []}
+    # Один кадр только выбирает кандидата: сессия ещё не пройдена, подтверждают её следующие кадры
+    # (/liveness_frame, /liveness_ws) по накопленным уликам с более строгим порогом, чем при оплате по карте
+    emp_id, card_uid, _ = matches[0]
+    session_id = await run_in_threadpool(create_session, card_uid, False, emp_id, {
+        "template": template.tolist(), "identified": True,
+        "accept_llr": face_evidence.identify_accept_llr(len(FACE_STORE)), "budget_match": False,
+    })
+    return {"status": "identified", "session_id": session_id, "candidates": candidates[:1]}
@@ -1,28 +1,34 @@
 import os
-import urllib.request, json, base64
-from fastapi import APIRouter, Depends, HTTPException
+import base64
+from fastapi import APIRouter, Depends, HTTPException, Request, Header
+from fastapi.concurrency import run_in_threadpool
+from fastapi.exceptions import RequestValidationError
 from sqlalchemy.orm import Session
-from sqlalchemy import func
-from app.database import get_db
-from app.models import CashDesk, Employee, Category, Product, Card, Transaction, WorkDay, RoleSetting, LivenessSession
-from pydantic import BaseModel
-from datetime import date, datetime, time
-from typing import List, Optional
-import csv
-import io
+from sqlalchemy import func, and_
+from app.database import get_db, get_async_db, run_db
+from app.role_cache import ROLE_CACHE
+from app.ledger import consume_subsidy, debit_limit, record_transactions
+from app.notifications import enqueue_message, enqueue_report
+from app.audit_store import AUDIT_STORE
+from app.export import period_filter, EXPORT_COLUMNS, COLUMNAR_FORMATS, columnar_available, iter_export_csv, iter_export_columnar
+from app.session_store import SESSION_STORE, LIVENESS_TTL_SEC
+from app.models import CashDesk, Employee, Category, Product, Card, Transaction, WorkDay, LivenessSession, DailySales, TransactionItem
+from pydantic import BaseModel, ValidationError
 from datetime import date, datetime, timedelta
+from typing import List, Optional
 from fastapi import Query
 from fastapi.responses import StreamingResponse
-from sqlalchemy import func
 
 
 router = APIRouter()
-TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 ADMIN_CHAT_ID = os.getenv("ADMIN_CHAT_ID")
+PAY_BATCH_MAX = int(os.getenv("PAY_BATCH_MAX", "500"))
+EXTERNAL_METHODS = {"cash": "НАЛИЧНЫМИ", "bank_card": "БАНКОВСКОЙ КАРТОЙ"}
 
 class OrderItem(BaseModel):
     name: str
     price: int
+    product_id: Optional[int] = None
 
 class ExternalPaymentRequest(BaseModel):
     cash_desk_id: str
@@ -30,6 +36,17 @@ class ExternalPaymentRequest(BaseModel):
     items: Optional[List[OrderItem]] = []
     payment_method: str
 
+class OfflineSale(BaseModel):
+    idempotency_key: str
+    amount_rub: float
+    items: Optional[List[OrderItem]] = []
+    payment_method: str
+    created_at: Optional[datetime] = None  # Время продажи на кассе, а не время синхронизации
+
+class PaymentBatchRequest(BaseModel):
+    cash_desk_id: str
+    sales: List[OfflineSale]
+
 class PaymentRequest(BaseModel):
     session_id: str
     amount_rub: int
@@ -38,127 +55,190 @@ class PaymentRequest(BaseModel):
     live_frame_base64: Optional[str] = None
     cash_desk_id: Optional[str] = "unknown"
 
-def send_tg_msg(chat_id, text):
-    if not chat_id or not TELEGRAM_BOT_TOKEN: return
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-    data = json.dumps({"chat_id": chat_id, "text": text, "parse_mode": "HTML"}).encode('utf-8')
-    req = urllib.request.Request(url, data=data, headers={'Content-Type': 'application/json'})
-    try: urllib.request.urlopen(req, timeout=5)
-    except: pass
-
-def send_tg_report(chat_id, db_photo_path, live_photo_b64, caption):
-    if not chat_id or not TELEGRAM_BOT_TOKEN: return
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMediaGroup"
-    boundary = "----WebKitFormBoundary7MA4YWxkTrZu0gW"
-    try:
-        live_bytes = base64.b64decode(live_photo_b64.split(",")[1])
-        with open(db_photo_path, "rb") as f: db_bytes = f.read()
-    except: return
-    media = [{"type": "photo", "media": "attach://p1", "caption": caption, "parse_mode": "HTML"}, {"type": "photo", "media": "attach://p2"}]
-    parts = [
-        f'--{boundary}\r\nContent-Disposition: form-data; name="chat_id"\r\n\r\n{chat_id}\r\n',
-        f'--{boundary}\r\nContent-Disposition: form-data; name="media"\r\n\r\n{json.dumps(media)}\r\n',
-        f'--{boundary}\r\nContent-Disposition: form-data; name="p1"; filename="1.jpg"\r\nContent-Type: image/jpeg\r\n\r\n'.encode('ascii'),
-        db_bytes, b'\r\n',
-        f'--{boundary}\r\nContent-Disposition: form-data; name="p2"; filename="2.jpg"\r\nContent-Type: image/jpeg\r\n\r\n'.encode('ascii'),
-        live_bytes, f'\r\n--{boundary}--\r\n'.encode('ascii')
-    ]
-    body = b''.join([p if isinstance(p, bytes) else p.encode('utf-8') for p in parts])
-    req = urllib.request.Request(url, data=body, headers={'Content-Type': f'multipart/form-data; boundary={boundary}'})
-    try: urllib.request.urlopen(req, timeout=15)
-    except: pass
+def items_summary(items, always_qty=False):
+    counts = {}
+    for i in items:
+        if i.name not in counts: counts[i.name] = {"qty": 0, "price": i.price}
+        counts[i.name]["qty"] += 1
+    lines = ""
+    for name, v in counts.items():
+        qty = v["qty"]
+        lines += f"• {name}{f' ({qty} шт.)' if qty > 1 or always_qty else ''} — {v['price'] * qty} руб.\n"
+    return lines
 
-@router.post("/pay_external")
-def pay_external(data: ExternalPaymentRequest, db: Session = Depends(get_db)):
-    total_bill_kop = int(data.amount_rub * 100)
-    
-    new_tx = Transaction(
+def external_row(cash_desk_id, amount_rub, items, payment_method, idempotency_key=None, created_at=None):
+    total_bill_kop = int(round(amount_rub * 100))
+    return dict(
         employee_id=None,
         amount_total_kopecks=total_bill_kop,
         subsidy_part_kopecks=0,
         limit_part_kopecks=total_bill_kop,
         status="COMPLETED",
-        created_at=datetime.now(),
-        cash_desk_id=data.cash_desk_id,
-        payment_method=data.payment_method,
-        items=[item.dict() for item in data.items]
+        created_at=created_at or datetime.now(),
+        cash_desk_id=cash_desk_id,
+        payment_method=payment_method,
+        items=[item.dict() for item in items],
+        idempotency_key=idempotency_key,
     )
-    db.add(new_tx)
-    db.commit()
 
-    counts = {}
-    for i in data.items:
-        if i.name not in counts: counts[i.name] = {"qty": 0, "price": i.price}
-        counts[i.name]["qty"] += 1
-    items_html = "".join([f"• {name} ({v['qty']} шт.) — {v['price']*v['qty']} руб.\n" for name, v in counts.items()])
-
-    method_name = "БАНКОВСКОЙ КАРТОЙ" if data.payment_method == 'bank_card' else "НАЛИЧНЫМИ"
+@router.post("/pay_external")
+def pay_external(data: ExternalPaymentRequest, db: Session = Depends(get_db),
+                 idempotency_key: Optional[str] = Header(None)):
+    # Повтор с тем же Idempotency-Key (касса не дождалась ответа) не создаёт вторую продажу
+    inserted = record_transactions(db, [external_row(
+        data.cash_desk_id, data.amount_rub, data.items, data.payment_method, idempotency_key
+    )])
+    if not inserted:
+        db.rollback()
+        return {"status": "success", "duplicate": True}
+
+    method_name = EXTERNAL_METHODS.get(data.payment_method, "НАЛИЧНЫМИ")
     admin_caption = (
         f"💳 <b>ОПЛАТА {method_name}</b>\n"
         f"🖥 Касса: {data.cash_desk_id}\n"
         f"💵 Сумма: {data.amount_rub} ₽\n"
-        f"🛒 <b>Заказ:</b>\n{items_html}"
+        f"🛒 <b>Заказ:</b>\n{items_summary(data.items, always_qty=True)}"
     )
-    send_tg_msg(ADMIN_CHAT_ID, admin_caption)
+    enqueue_message(db, ADMIN_CHAT_ID, admin_caption)
+    db.commit()
     return {"status": "success"}
 
+@router.post("/pay_batch")
+def pay_batch(data: PaymentBatchRequest, db: Session = Depends(get_db)):
+    # Офлайн-продажи кассы (наличные/карта) одной вставкой; результат по каждой продаже отдельно
+    if len(data.sales) > PAY_BATCH_MAX:
+        raise HTTPException(413, f"Не больше {PAY_BATCH_MAX} продаж за раз")
+    results, rows, seen = {}, [], set()
+    for sale in data.sales:
+        key = sale.idempotency_key
+        if key in seen:
+            continue
+        seen.add(key)
+        if sale.payment_method not in EXTERNAL_METHODS:
+            results[key] = {"status": "rejected", "detail": "Офлайн принимаются только наличные и карта"}
+        elif sale.amount_rub <= 0:
+            results[key] = {"status": "rejected", "detail": "Некорректная сумма"}
+        else:
+            rows.append(external_row(data.cash_desk_id, sale.amount_rub, sale.items, sale.payment_method, key, sale.created_at))
+    inserted = {r.idempotency_key for r in record_transactions(db, rows)}
+    for row in rows:
+        results[row["idempotency_key"]] = {"status": "created" if row["idempotency_key"] in inserted else "duplicate"}
+
+    if inserted:
+        created = [r for r in rows if r["idempotency_key"] in inserted]
+        total_rub = sum(r["amount_total_kopecks"] for r in created) / 100
+        enqueue_message(db, ADMIN_CHAT_ID, (
+            f"📦 <b>СИНХРОНИЗАЦИЯ ОФЛАЙН-ПРОДАЖ</b>\n"
+            f"🖥 Касса: {data.cash_desk_id}\n"
+            f"🧾 Продаж: {len(created)}\n"
+            f"💵 Сумма: {total_rub:.2f} ₽"
+        ))
+    db.commit()
+    return {"results": [{"idempotency_key": k, **v} for k, v in results.items()]}
+
+def parse_payment(raw):
+    try:
+        return PaymentRequest.parse_raw(raw)
+    except ValidationError as e:
+        raise RequestValidationError(e.raw_errors)
+
+def save_legacy_frame(live_frame_base64):
+    # Старые кассы присылают кадр data URL внутри JSON
+    try:
+        return AUDIT_STORE.save_bytes(base64.b64decode(live_frame_base64.split(",")[-1]))
+    except ValueError:
+        return None, False
+
 @router.post("/pay")
-def pay(data: PaymentRequest, db: Session = Depends(get_db)):
-    sess = db.query(LivenessSession).filter(LivenessSession.id == data.session_id).first()
-    if not sess: raise HTTPException(404, "Сессия не найдена")
-
-    card = db.query(Card).filter(Card.uid == sess.card_uid).first()
-    emp = db.query(Employee).filter(Employee.id == card.employee_id).first()
-
-    is_work_day = db.query(WorkDay).filter(WorkDay.employee_id == emp.id, WorkDay.date == date.today()).first() is not None
-    role_set = db.query(RoleSetting).filter(RoleSetting.role_name == emp.role).first()
-    daily_subsidy_limit_kop = float(role_set.subsidy_rub * 100) if (role_set and is_work_day) else 0.0
-
-    total_bill_kop = float(data.amount_rub * 100)
-    applied_subsidy_kop = 0.0
-
-    if daily_subsidy_limit_kop > 0:
-        start_of_today = datetime.combine(date.today(), time.min)
-        raw_used = db.query(func.sum(Transaction.subsidy_part_kopecks)).filter(
-            Transaction.employee_id == emp.id,
-            Transaction.created_at >= start_of_today
-        ).scalar()
-        used_today_kop = float(raw_used) if raw_used is not None else 0.0
-        
-        available_today_kop = max(0.0, daily_subsidy_limit_kop - used_today_kop)
-        applied_subsidy_kop = min(total_bill_kop, available_today_kop)
-
-    withdraw_rub = (total_bill_kop - applied_subsidy_kop) / 100.0
-
-    if emp.month_limit_rub < withdraw_rub:
+async def pay(request: Request, db=Depends(get_async_db), idempotency_key: Optional[str] = Header(None)):
+    # JSON — как раньше; multipart/form-data — поле payment (тот же JSON) и файл frame с кадром ручной оплаты.
+    # Кадр пишется потоком в хранилище аудита, в отчёт уходит только путь к файлу
+    frame_path, frame_created = None, False
+    if request.headers.get("content-type", "").startswith("multipart/form-data"):
+        form = await request.form()
+        data = parse_payment(form.get("payment") or "{}")
+        frame = form.get("frame")
+        if data.is_manual and frame is not None and hasattr(frame, "file"):
+            frame_path, frame_created = await run_in_threadpool(AUDIT_STORE.save, frame.file)
+    else:
+        data = parse_payment(await request.body())
+        if data.is_manual and data.live_frame_base64:
+            frame_path, frame_created = await run_in_threadpool(save_legacy_frame, data.live_frame_base64)
+    try:
+        result = await run_db(db, process_payment, data, frame_path, idempotency_key)
+    except BaseException:
+        # Отказ (сессия, лимит, подтверждение лица) — на кадр никто не ссылается, не оставляем его на диске
+        if frame_created: await run_in_threadpool(AUDIT_STORE.discard, frame_path)
+        raise
+    if frame_created and result.get("duplicate"):
+        # Повтор уже проведённой оплаты: отчёт ушёл с кадром первой попытки
+        await run_in_threadpool(AUDIT_STORE.discard, frame_path)
+    return result
+
+def duplicate_payment(db, idempotency_key):
+    row = db.query(Employee.month_limit_rub).select_from(Transaction).join(
+        Employee, Employee.id == Transaction.employee_id
+    ).filter(Transaction.idempotency_key == idempotency_key).first()
+    return None if row is None else {"status": "success", "remaining_limit": round(row[0], 2), "duplicate": True}
+
+def process_payment(db: Session, data: PaymentRequest, frame_path=None, idempotency_key=None):
+    # Один запрос на всё: сессия, сотрудник (по employee_id сессии или по карте) и рабочий день
+    today = date.today()
+    row = db.query(
+        LivenessSession, Employee, WorkDay.id.isnot(None).label("is_work_day")
+    ).outerjoin(
+        Card, and_(LivenessSession.employee_id.is_(None), Card.uid == LivenessSession.card_uid)
+    ).join(
+        Employee, Employee.id == func.coalesce(LivenessSession.employee_id, Card.employee_id)
+    ).outerjoin(
+        WorkDay, and_(WorkDay.employee_id == Employee.id, WorkDay.date == today)
+    ).filter(LivenessSession.id == data.session_id).first()
+    if not row or row[0].timestamp < datetime.now() - timedelta(seconds=LIVENESS_TTL_SEC):
+        # Повтор уже проведённой оплаты: сессию удалила первая попытка, отвечаем тем же успехом.
+        # Проверяем только здесь, чтобы не добавлять запрос к каждой обычной оплате
+        done = duplicate_payment(db, idempotency_key) if idempotency_key else None
+        if done: return done
+        raise HTTPException(404, "Сессия не найдена или истекла")
+    sess, emp, is_work_day = row
+    # Сессия из поиска по лицу (без карты) оплачивается только после подтверждения кадрами, ручной оплаты нет
+    state = sess.state if SESSION_STORE.blocking else (SESSION_STORE.get(data.session_id) or sess.state)
+    if state and state.get("identified") and not state.get("passed"):
+        raise HTTPException(403, "Лицо ещё не подтверждено")
+    emp_id, emp_name, emp_tg, card_uid = emp.id, emp.full_name, emp.telegram_id, sess.card_uid
+
+    # Дотация роли — из кэша в памяти, сбрасывается эндпоинтами /role_settings
+    role_subsidy_rub = ROLE_CACHE.subsidy_rub(db, emp.role)
+    daily_subsidy_limit_kop = int(round(role_subsidy_rub * 100)) if (role_subsidy_rub and is_work_day) else 0
+    total_bill_kop = int(data.amount_rub) * 100
+
+    # Дотация и лимит списываются условными UPDATE без чтения-изменения-записи:
+    # две одновременные оплаты не могут обе потратить один и тот же остаток
+    applied_subsidy_kop = consume_subsidy(db, emp_id, today, daily_subsidy_limit_kop, total_bill_kop)
+    withdraw_kop = total_bill_kop - applied_subsidy_kop
+    remaining_rub = debit_limit(db, emp_id, withdraw_kop)
+    if remaining_rub is None:
+        db.rollback()
         raise HTTPException(status_code=400, detail="Недостаточно личных средств")
 
-    new_tx = Transaction(
-        employee_id=emp.id,
-        amount_total_kopecks=int(total_bill_kop),
-        subsidy_part_kopecks=int(applied_subsidy_kop),
-        limit_part_kopecks=int(total_bill_kop - applied_subsidy_kop),
+    inserted = record_transactions(db, [dict(
+        employee_id=emp_id,
+        amount_total_kopecks=total_bill_kop,
+        subsidy_part_kopecks=applied_subsidy_kop,
+        limit_part_kopecks=withdraw_kop,
         status="COMPLETED",
         created_at=datetime.now(),
         cash_desk_id=data.cash_desk_id,
         payment_method="internal",
-        items=[item.dict() for item in data.items]
-    )
-    
-    emp.month_limit_rub -= withdraw_rub
-    db.add(new_tx)
+        items=[item.dict() for item in data.items],
+        idempotency_key=idempotency_key,
+    )])
+    if not inserted:
+        # Параллельный повтор с тем же ключом успел раньше — откатываем свои списания
+        db.rollback()
+        return duplicate_payment(db, idempotency_key)
     db.delete(sess)
-    db.commit()
 
-    counts = {}
-    for i in data.items:
-        if i.name not in counts: counts[i.name] = {"qty": 0, "price": i.price}
-        counts[i.name]["qty"] += 1
-    
-    items_html = ""
-    for name, v in counts.items():
-        qty = v["qty"]
-        items_html += f"• {name}{f' ({qty} шт.)' if qty > 1 else ''} — {v['price'] * qty} руб.\n"
+    items_html = items_summary(data.items)
 
     user_receipt = (
         f"💳 <b>Оплата принята</b>\n"
@@ -166,21 +246,24 @@ def pay(data: PaymentRequest, db: Session = Depends(get_db)):
         f"🛒 <b>Состав заказа:</b>\n{items_html}"
         f"━━━━━━━━━━━━━━━\n"
         f"💰 Сумма: {float(data.amount_rub):.2f} ₽\n"
-        f"🥗 Дотация: {float(applied_subsidy_kop/100):.2f} ₽\n"
-        f"💳 Из лимита: {float(withdraw_rub):.2f} ₽\n\n"
-        f"📉 <b>Остаток: {round(emp.month_limit_rub, 1)} ₽</b>"
+        f"🥗 Дотация: {applied_subsidy_kop / 100:.2f} ₽\n"
+        f"💳 Из лимита: {withdraw_kop / 100:.2f} ₽\n\n"
+        f"📉 <b>Остаток: {round(remaining_rub, 1)} ₽</b>"
     )
-    send_tg_msg(emp.telegram_id, user_receipt)
+    # Уведомления пишутся в outbox той же транзакцией и уходят фоновым воркером — касса не ждёт Telegram
+    enqueue_message(db, emp_tg, user_receipt)
 
-    if data.is_manual and data.live_frame_base64:
-        db_photo = f"/app/static/photos/{sess.card_uid}.jpg"
+    if data.is_manual and frame_path:
+        db_photo = f"/app/static/photos/{card_uid}.jpg"
         if os.path.exists(db_photo):
-            admin_caption = (f"⚠️ <b>РУЧНАЯ ОПЛАТА</b>\n━━━━━━━━━━━━━━━\n👤 <b>{emp.full_name}</b>\n"
+            admin_caption = (f"⚠️ <b>РУЧНАЯ ОПЛАТА</b>\n━━━━━━━━━━━━━━━\n👤 <b>{emp_name}</b>\n"
                              f"🖥 Касса: {data.cash_desk_id}\n"
                              f"💵 Сумма: {data.amount_rub} ₽\n🛒 <b>Заказ:</b>\n{items_html}")
-            send_tg_report(ADMIN_CHAT_ID, db_photo, data.live_frame_base64, admin_caption)
+            enqueue_report(db, ADMIN_CHAT_ID, db_photo, frame_path, admin_caption)
 
-    return {"status": "success", "remaining_limit": round(emp.month_limit_rub, 2)}
+    db.commit()
+    if not SESSION_STORE.blocking: SESSION_STORE.delete(data.session_id)
+    return {"status": "success", "remaining_limit": round(remaining_rub, 2)}
 
 class CashDeskCreate(BaseModel):
     login: str
@@ -305,22 +388,17 @@ def get_statistics_chart(
     db: Session = Depends(get_db)
 ):
     try:
-        # Группируем по дате И по кассе
+        # Читаем готовую сводку daily_sales: объём работы зависит от числа дней, а не от истории транзакций
         query = db.query(
-            func.date(Transaction.created_at).label('day'),
-            Transaction.cash_desk_id,
-            func.sum(Transaction.amount_total_kopecks).label('total')
-        ).filter(
-            func.date(Transaction.created_at) >= start_date,
-            func.date(Transaction.created_at) <= end_date
-        )
+            DailySales.day, DailySales.cash_desk_id, func.sum(DailySales.amount_kopecks).label('total')
+        ).filter(DailySales.day >= start_date, DailySales.day <= end_date)
 
         if payment_methods:
-            query = query.filter(Transaction.payment_method.in_(payment_methods))
+            query = query.filter(DailySales.payment_method.in_(payment_methods))
         if cash_desks:
-            query = query.filter(Transaction.cash_desk_id.in_(cash_desks))
+            query = query.filter(DailySales.cash_desk_id.in_(cash_desks))
 
-        results = query.group_by(func.date(Transaction.created_at), Transaction.cash_desk_id).all()
+        results = query.group_by(DailySales.day, DailySales.cash_desk_id).all()
 
         # Формируем структуру: { "касса": { "дата": сумма } }
         desk_data = {}
@@ -349,41 +427,62 @@ def get_statistics_chart(
         print(f"Error: {e}")
         return {"labels": [], "datasets": []}
 
+@router.get("/statistics/products")
+def get_statistics_products(
+    start_date: date = Query(...),
+    end_date: date = Query(...),
+    cash_desks: Optional[List[str]] = Query(None),
+    limit: int = Query(50, ge=1, le=1000),
+    db: Session = Depends(get_db)
+):
+    # Выручка и количество по товарам и категориям — GROUP BY по transaction_items, без разбора JSON
+    def scoped(query):
+        query = query.join(Transaction, Transaction.id == TransactionItem.transaction_id).filter(*period_filter(start_date, end_date))
+        if cash_desks:
+            query = query.filter(Transaction.cash_desk_id.in_(cash_desks))
+        return query
+
+    qty = func.sum(TransactionItem.qty).label("qty")
+    revenue = func.sum(TransactionItem.qty * TransactionItem.price_kopecks).label("revenue")
+    products = scoped(db.query(
+        TransactionItem.product_id, TransactionItem.name, func.max(TransactionItem.category_id).label("category_id"), qty, revenue
+    )).group_by(TransactionItem.product_id, TransactionItem.name).order_by(revenue.desc()).limit(limit).all()
+    categories = scoped(db.query(
+        TransactionItem.category_id, Category.name, qty, revenue
+    ).outerjoin(Category, Category.id == TransactionItem.category_id)).group_by(
+        TransactionItem.category_id, Category.name
+    ).order_by(revenue.desc()).all()
+
+    return {
+        "products": [{"product_id": r.product_id, "name": r.name, "category_id": r.category_id,
+                      "qty": int(r.qty), "revenue_rub": r.revenue / 100} for r in products],
+        "categories": [{"category_id": r.category_id, "name": r.name or "Без категории",
+                        "qty": int(r.qty), "revenue_rub": r.revenue / 100} for r in categories],
+    }
+
 @router.get("/statistics/export")
 def export_statistics_csv(
     start_date: date = Query(...),
     end_date: date = Query(...),
-    db: Session = Depends(get_db)
+    columns: Optional[List[str]] = Query(None),
+    format: str = Query("csv")
 ):
-    # Выгружаем транзакции за период
-    transactions = db.query(Transaction).filter(
-        func.date(Transaction.created_at) >= start_date,
-        func.date(Transaction.created_at) <= end_date
-    ).all()
-
-    # Используем StringIO для создания CSV
-    stream = io.StringIO()
-    writer = csv.writer(stream, delimiter=';', dialect='excel')
-
-    # Заголовки колонок
-    writer.writerow(["ID", "Дата", "Касса", "Метод", "Сумма (РУБ)"])
-
-    for t in transactions:
-        # Конвертируем копейки в рубли через float
-        rubles = float(t.amount_total_kopecks) / 100.0 if t.amount_total_kopecks else 0.0
-        writer.writerow([
-            t.id,
-            t.created_at.strftime("%Y-%m-%d %H:%M") if t.created_at else "",
-            t.cash_desk_id,
-            t.payment_method,
-            f"{rubles:.2f}".replace('.', ',') # Запятая лучше для русского Excel
-        ])
-
-    # ВАЖНО: Добавляем BOM (u'\ufeff') и кодируем в utf-8-sig для Excel
-    content = u'\ufeff' + stream.getvalue()
-    
+    # csv — для Excel; parquet/arrow — типизированные колонки для аналитики (нужен pyarrow)
+    filename = f"export_{start_date}_{end_date}"
+    if format in COLUMNAR_FORMATS:
+        if not columnar_available():
+            raise HTTPException(501, "Выгрузка в Parquet/Arrow недоступна: на сервере не установлен pyarrow")
+        media_type, ext = COLUMNAR_FORMATS[format]
+        return StreamingResponse(
+            iter_export_columnar(start_date, end_date, format), media_type=media_type,
+            headers={"Content-Disposition": f"attachment; filename={filename}.{ext}"}
+        )
+    if format != "csv":
+        raise HTTPException(400, "Формат: csv, parquet или arrow")
+    # Дополнительные колонки CSV: employee, split (дотация/лимит), items
+    columns = {c for c in (columns or []) if c in EXPORT_COLUMNS}
     return StreamingResponse(
-        iter([content.encode("utf-8-sig")]), 
-        media_type="text/csv; charset=utf-8-sig",
-        headers={"Content-Disposition": f"attachment; filename=export_{start_date}_{end_date}.csv"}
+        iter_export_csv(start_date, end_date, columns),
+        media_type="text/csv; charset=utf-8",
+        headers={"Content-Disposition": f"attachment; filename={filename}.csv"}
     )
@@ -0,0 +1,115 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from app.database import SessionLocal
+from app.models import LivenessSession
+
+# memory — сессии в памяти процесса (один воркер uvicorn), db — общая таблица liveness_sessions
+LIVENESS_STORE = os.getenv("LIVENESS_STORE", "memory")
+LIVENESS_TTL_SEC = int(os.getenv("LIVENESS_TTL_SEC", "300"))
+LIVENESS_MAX_SESSIONS = int(os.getenv("LIVENESS_MAX_SESSIONS", "1000"))
+LIVENESS_SWEEP_SEC = int(os.getenv("LIVENESS_SWEEP_SEC", "60"))
+
+def sweep_db_sessions(ttl=LIVENESS_TTL_SEC):
+    # Брошенные сессии (не дошли до оплаты) удаляем из БД в любом режиме
+    db = SessionLocal()
+    try:
+        deleted = db.query(LivenessSession).filter(
+            LivenessSession.timestamp < datetime.now() - timedelta(seconds=ttl)
+        ).delete(synchronize_session=False)
+        db.commit()
+        return deleted
+    finally:
+        db.close()
+
+class MemorySessionStore:
+    blocking = False
+
+    def __init__(self, ttl=LIVENESS_TTL_SEC, max_size=LIVENESS_MAX_SESSIONS):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._items = OrderedDict()  # sid -> (expires_at, state), старые в начале
+        self._lock = threading.Lock()
+
+    def create(self, sid, state):
+        with self._lock:
+            self._evict_expired()
+            while len(self._items) >= self.max_size:
+                self._items.popitem(last=False)
+            self._items[sid] = (time.monotonic() + self.ttl, state)
+
+    def get(self, sid):
+        with self._lock:
+            item = self._items.get(sid)
+            if item is None:
+                return None
+            if item[0] < time.monotonic():
+                del self._items[sid]
+                return None
+            return item[1]
+
+    def save(self, sid, state):
+        # Состояние меняется на месте, сохранять нечего
+        pass
+
+    def delete(self, sid):
+        with self._lock:
+            self._items.pop(sid, None)
+
+    def sweep(self):
+        with self._lock:
+            return self._evict_expired()
+
+    def _evict_expired(self):
+        now, expired = time.monotonic(), 0
+        while self._items:
+            sid, (expires_at, _) = next(iter(self._items.items()))
+            if expires_at >= now:
+                break
+            del self._items[sid]
+            expired += 1
+        return expired
+
+class DBSessionStore:
+    # Состояние лежит в liveness_sessions.state, поэтому сессия видна всем воркерам
+    blocking = True
+
+    def __init__(self, ttl=LIVENESS_TTL_SEC):
+        self.ttl = ttl
+
+    def create(self, sid, state):
+        # Строку вместе с состоянием вставляет create_session, дополнительных действий не нужно
+        pass
+
+    def get(self, sid):
+        db = SessionLocal()
+        try:
+            row = db.query(LivenessSession.state, LivenessSession.timestamp).filter(LivenessSession.id == sid).first()
+        finally:
+            db.close()
+        if row is None or row.state is None or row.timestamp < datetime.now() - timedelta(seconds=self.ttl):
+            return None
+        return dict(row.state)
+
+    def save(self, sid, state):
+        db = SessionLocal()
+        try:
+            db.query(LivenessSession).filter(LivenessSession.id == sid).update({"state": state}, synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+    def delete(self, sid):
+        db = SessionLocal()
+        try:
+            db.query(LivenessSession).filter(LivenessSession.id == sid).delete(synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+    def sweep(self):
+        return 0
+
+SESSION_STORE = DBSessionStore() if LIVENESS_STORE == "db" else MemorySessionStore()
@@ -0,0 +1,47 @@
+# Заполнение transaction_items по JSON-полю transactions.items для старых транзакций.
+# Запуск: python backfill_transaction_items.py [--since 2024-01-01] [--batch 5000]
+# Повторный запуск безопасен: транзакции, у которых позиции уже есть, пропускаются.
+import argparse
+from datetime import date, datetime, time
+from sqlalchemy import text, func
+from app.database import SessionLocal, Base, engine
+from app.models import Transaction, TransactionItem
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--since", type=date.fromisoformat)
+parser.add_argument("--batch", type=int, default=5000)
+args = parser.parse_args()
+since = datetime.combine(args.since, time.min) if args.since else datetime.min
+
+# Товар ищем по product_id из позиции, у старых касс — по названию (первый товар с таким именем)
+FILL = text("""
+INSERT INTO transaction_items (transaction_id, product_id, category_id, name, price_kopecks, qty)
+SELECT t.id, p.id, p.category_id, e->>'name', round((e->>'price')::numeric * 100)::int, count(*)
+FROM transactions t
+CROSS JOIN LATERAL json_array_elements(t.items) AS e
+LEFT JOIN LATERAL (
+    SELECT id, category_id FROM products
+    WHERE CASE WHEN e->>'product_id' IS NOT NULL THEN id = (e->>'product_id')::int ELSE name = e->>'name' END
+    ORDER BY id LIMIT 1
+) p ON true
+WHERE t.id > :lo AND t.id <= :hi AND t.created_at >= :since
+  AND json_typeof(t.items) = 'array'
+  AND NOT EXISTS (SELECT 1 FROM transaction_items ti WHERE ti.transaction_id = t.id)
+GROUP BY t.id, p.id, p.category_id, e->>'name', round((e->>'price')::numeric * 100)::int
+""")
+
+Base.metadata.create_all(bind=engine, tables=[TransactionItem.__table__])
+db = SessionLocal()
+try:
+    lo, top = db.query(func.min(Transaction.id) - 1, func.max(Transaction.id)).one()
+    total = 0
+    while top is not None and lo < top:
+        # Пачками по диапазону id: короткие транзакции, прогресс не теряется при обрыве
+        hi = lo + args.batch
+        total += db.execute(FILL, {"lo": lo, "hi": hi, "since": since}).rowcount
+        db.commit()
+        print(f"id ≤ {min(hi, top)}: вставлено позиций {total}")
+        lo = hi
+    print(f"✅ Готово, позиций: {total}")
+finally:
+    db.close()
@@ -0,0 +1,64 @@
+# Сравнение CV-бэкендов на своих фото: скорость детекции/кодирования и точность.
+# Файлы называются <метка>_<n>.jpg (одна метка — один человек), например 04A1B2_1.jpg, 04A1B2_2.jpg.
+# Запуск: python bench_cv.py photos_dir/ [--detectors dlib_hog,mediapipe] [--scale 2]
+import argparse
+import os
+import time
+import itertools
+import numpy as np
+import cv2
+from app.cv_backends import DETECTORS, get_detector, get_encoder
+from app.cv_utils import FACE_TOLERANCE, _DECODE_FLAGS, _largest
+
+def load_images(path, scale):
+    images = []
+    for name in sorted(os.listdir(path)):
+        if not name.lower().endswith((".jpg", ".jpeg", ".png")):
+            continue
+        with open(os.path.join(path, name), "rb") as f:
+            img = cv2.imdecode(np.frombuffer(f.read(), np.uint8), _DECODE_FLAGS.get(scale, cv2.IMREAD_COLOR))
+        if img is not None:
+            images.append((os.path.splitext(name)[0].rsplit("_", 1)[0], cv2.cvtColor(img, cv2.COLOR_BGR2RGB)))
+    return images
+
+def run(detector_name, images):
+    detector, encoder = get_detector(detector_name), get_encoder()
+    detector.detect(images[0][1])  # прогрев
+    detect_ms, encode_ms, embeddings = [], [], []
+    for label, rgb in images:
+        t0 = time.perf_counter()
+        box = _largest(detector.detect(rgb))
+        t1 = time.perf_counter()
+        detect_ms.append((t1 - t0) * 1000)
+        if box is None:
+            continue
+        emb = encoder.encode(rgb, box)
+        encode_ms.append((time.perf_counter() - t1) * 1000)
+        if emb is not None:
+            embeddings.append((label, emb))
+
+    genuine, impostor = [], []
+    for (l1, e1), (l2, e2) in itertools.combinations(embeddings, 2):
+        (genuine if l1 == l2 else impostor).append(float(np.linalg.norm(e1 - e2)))
+    frr = np.mean([d > FACE_TOLERANCE for d in genuine]) if genuine else float("nan")
+    far = np.mean([d <= FACE_TOLERANCE for d in impostor]) if impostor else float("nan")
+    print(
+        f"{detector_name:<12} найдено {len(embeddings)}/{len(images)} | "
+        f"детекция {np.mean(detect_ms):6.1f} мс | кодирование {np.mean(encode_ms) if encode_ms else 0:6.1f} мс | "
+        f"свой {np.mean(genuine) if genuine else float('nan'):.3f} / чужой {np.mean(impostor) if impostor else float('nan'):.3f} | "
+        f"FRR {frr:.3f} FAR {far:.4f} (порог {FACE_TOLERANCE})"
+    )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path")
+    parser.add_argument("--detectors", default=",".join(DETECTORS))
+    parser.add_argument("--scale", type=int, default=1)
+    args = parser.parse_args()
+
+    images = load_images(args.path, args.scale)
+    if not images:
+        raise SystemExit("Нет изображений")
+    print(f"{len(images)} изображений, масштаб 1/{args.scale}")
+    for name in args.detectors.split(","):
+        run(name.strip(), images)
@@ -0,0 +1,53 @@
+# Сравнение форматов выгрузки транзакций: время выгрузки, размер файла, пик памяти и время загрузки обратно.
+# Запуск: python bench_export.py --start 2024-01-01 --end 2024-12-31 [--formats csv,parquet,arrow]
+import argparse
+import csv
+import io
+import time
+import tracemalloc
+from datetime import date
+from app.export import iter_export_csv, iter_export_columnar, columnar_available, EXPORT_COLUMNS
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--start", type=date.fromisoformat, required=True)
+parser.add_argument("--end", type=date.fromisoformat, required=True)
+parser.add_argument("--formats", default="csv,parquet,arrow")
+args = parser.parse_args()
+
+def produce(fmt):
+    if fmt == "csv":
+        return iter_export_csv(args.start, args.end, set(EXPORT_COLUMNS))
+    return iter_export_columnar(args.start, args.end, fmt)
+
+def load_back(fmt, data):
+    # Как это делает потребитель: CSV нужно разобрать и перевести суммы из "12,50" в числа
+    if fmt == "csv":
+        reader = csv.reader(io.StringIO(data.decode("utf-8-sig")), delimiter=';')
+        next(reader)
+        return sum(1 for row in reader if float(row[4].replace(',', '.')) >= 0)
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    if fmt == "parquet":
+        return pq.read_table(io.BytesIO(data)).num_rows
+    return pa.ipc.open_stream(data).read_all().num_rows
+
+print(f"{'формат':<8} {'выгрузка, с':>12} {'размер, МБ':>11} {'пик памяти, МБ':>15} {'загрузка, с':>12} {'строк':>9}")
+for fmt in args.formats.split(","):
+    if fmt != "csv" and not columnar_available():
+        print(f"{fmt:<8} пропущен: не установлен pyarrow")
+        continue
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    out = io.BytesIO()
+    for chunk in produce(fmt):
+        out.write(chunk)
+    t_export = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    data = out.getvalue()
+    t0 = time.perf_counter()
+    rows = load_back(fmt, data)
+    t_load = time.perf_counter() - t0
+    # Пик памяти включает накопленный в BytesIO файл — его размер вычитаем
+    print(f"{fmt:<8} {t_export:>12.2f} {len(data) / 2**20:>11.2f} {(peak - len(data)) / 2**20:>15.1f} {t_load:>12.2f} {rows:>9}")
@@ -0,0 +1,31 @@
+# Массовая загрузка лиц из архива фотографий <card_uid>.jpg.
+# Запуск: python bulk_enroll.py photos.zip|photos_dir/ [--workers 4] [--batch-size 100] [--report report.csv]
+import argparse
+import csv
+from app.database import SessionLocal
+from app.bulk_enroll import enroll_photos, iter_photos, summarize, BULK_ENROLL_WORKERS, BULK_ENROLL_BATCH
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("source")
+    parser.add_argument("--workers", type=int, default=BULK_ENROLL_WORKERS)
+    parser.add_argument("--batch-size", type=int, default=BULK_ENROLL_BATCH)
+    parser.add_argument("--photos-dir", default="static/photos")
+    parser.add_argument("--report")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        report = enroll_photos(db, iter_photos(args.source), args.photos_dir, workers=args.workers, batch_size=args.batch_size)
+    finally:
+        db.close()
+
+    for row in report:
+        if row["status"] != "ok":
+            print(f"⚠️ {row['file']}: {row['status']}")
+    if args.report:
+        with open(args.report, "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=["file", "card_uid", "status"])
+            writer.writeheader()
+            writer.writerows(report)
+    print(f"✅ Готово: {summarize(report)['counts']}")
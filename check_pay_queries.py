@@ -0,0 +1,81 @@
+# Проверка числа SQL-запросов одной оплаты (/pay): ловит возврат N+1 и лишних предварительных запросов.
+# Всё выполняется внутри внешней транзакции и откатывается — база не меняется.
+# Запуск (на тестовой базе): python check_pay_queries.py --card 04A1B2C3 [--amount 1] [--budget 9]
+import argparse
+import uuid
+from datetime import datetime
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from fastapi import HTTPException
+from app.database import engine
+from app.models import LivenessSession, Card
+from app.role_cache import ROLE_CACHE
+from app.routers.payment import process_payment, PaymentRequest
+
+# Оплата с прогретым кэшем ролей: сессия+сотрудник+рабочий день, дотация, лимит, транзакция,
+# дневная сводка, товары, позиции чека, удаление сессии, уведомление в outbox
+PAY_QUERY_BUDGET = 9
+# Повтор с тем же Idempotency-Key: сессии уже нет, плюс поиск проведённой оплаты
+REPLAY_QUERY_BUDGET = 2
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--card", required=True)
+parser.add_argument("--amount", type=int, default=1, help="Сумма оплаты, руб.")
+parser.add_argument("--budget", type=int, default=PAY_QUERY_BUDGET)
+parser.add_argument("-v", "--verbose", action="store_true", help="Показать сами запросы")
+args = parser.parse_args()
+
+statements = []
+
+def count(conn, cursor, statement, parameters, context, executemany):
+    # SAVEPOINT/RELEASE добавляет сама обвязка проверки, в рабочей оплате их нет
+    if statement.lstrip().upper().startswith(("SAVEPOINT", "RELEASE SAVEPOINT", "ROLLBACK TO SAVEPOINT")):
+        return
+    statements.append(" ".join(statement.split())[:120])
+
+def measure(fn):
+    statements.clear()
+    event.listen(engine, "before_cursor_execute", count)
+    try:
+        result = fn()
+    finally:
+        event.remove(engine, "before_cursor_execute", count)
+    return result, list(statements)
+
+conn = engine.connect()
+outer = conn.begin()
+# commit() внутри process_payment закрывает только SAVEPOINT, внешняя транзакция откатывается в конце
+db = Session(bind=conn, join_transaction_mode="create_savepoint")
+try:
+    card = db.query(Card).filter(Card.uid == args.card.strip()).first()
+    if card is None:
+        raise SystemExit(f"Карта {args.card} не найдена")
+    sid, key = str(uuid.uuid4()), f"qcheck-{uuid.uuid4()}"
+    db.add(LivenessSession(id=sid, card_uid=card.uid, employee_id=card.employee_id, timestamp=datetime.now(), state=None))
+    db.commit()
+    ROLE_CACHE.subsidy_rub(db, None)  # Рабочий режим — кэш ролей уже прогрет
+
+    data = PaymentRequest(session_id=sid, amount_rub=args.amount, cash_desk_id="qcheck",
+                          items=[{"name": "Проверка запросов", "price": args.amount}])
+    try:
+        result, pay_sql = measure(lambda: process_payment(db, data, idempotency_key=key))
+        replay, replay_sql = measure(lambda: process_payment(db, data, idempotency_key=key))
+    except HTTPException as e:
+        raise SystemExit(f"❌ Оплата не прошла: {e.detail}")
+finally:
+    db.close()
+    outer.rollback()
+    conn.close()
+
+failed = False
+for title, sql, budget in (("Оплата", pay_sql, args.budget), ("Повтор", replay_sql, REPLAY_QUERY_BUDGET)):
+    ok = len(sql) <= budget
+    failed |= not ok
+    print(f"{'✅' if ok else '❌'} {title}: {len(sql)} запросов (бюджет {budget})")
+    if args.verbose or not ok:
+        for s in sql:
+            print(f"    {s}")
+if result.get("status") != "success" or not replay.get("duplicate"):
+    print(f"❌ Неожиданный ответ: {result} / {replay}")
+    failed = True
+raise SystemExit(1 if failed else 0)
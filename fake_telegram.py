@@ -0,0 +1,60 @@
+# Локальная заглушка Telegram Bot API для проверки очереди уведомлений без настоящего бота.
+# Запуск: python fake_telegram.py [--port 8081] [--latency 0.2] [--fail-rate 0.1] [--rate-limit 30] [--down]
+# В .env приложения: TELEGRAM_API_URL=http://localhost:8081
+import argparse
+import asyncio
+import random
+import time
+from collections import deque
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+import uvicorn
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--port", type=int, default=8081)
+parser.add_argument("--latency", type=float, default=0.1, help="Задержка ответа, сек")
+parser.add_argument("--fail-rate", type=float, default=0.0, help="Доля ответов 502")
+parser.add_argument("--rate-limit", type=int, default=30, help="Сообщений в секунду до ответа 429")
+parser.add_argument("--down", action="store_true", help="Отвечать 503 на всё (проверка circuit breaker)")
+args = parser.parse_args()
+
+app = FastAPI()
+recent = deque()
+stats = {"ok": 0, "429": 0, "5xx": 0}
+
+def reply(method, chat_id):
+    now = time.monotonic()
+    while recent and now - recent[0] > 1:
+        recent.popleft()
+    if args.down or random.random() < args.fail_rate:
+        stats["5xx"] += 1
+        return JSONResponse({"ok": False, "description": "Bad Gateway"}, status_code=503 if args.down else 502)
+    if len(recent) >= args.rate_limit:
+        stats["429"] += 1
+        return JSONResponse({"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                             "parameters": {"retry_after": 1}}, status_code=429)
+    recent.append(now)
+    stats["ok"] += 1
+    print(f"{method} → {chat_id} (ok={stats['ok']}, 429={stats['429']}, 5xx={stats['5xx']})")
+    return {"ok": True, "result": {"message_id": stats["ok"], "chat": {"id": chat_id}}}
+
+@app.post("/bot{token}/sendMessage")
+async def send_message(token: str, request: Request):
+    await asyncio.sleep(args.latency)
+    body = await request.json()
+    return reply("sendMessage", body.get("chat_id"))
+
+@app.post("/bot{token}/sendMediaGroup")
+async def send_media_group(token: str, request: Request):
+    await asyncio.sleep(args.latency)
+    form = await request.form()
+    return reply("sendMediaGroup", form.get("chat_id"))
+
+@app.get("/bot{token}/getUpdates")
+async def get_updates(token: str, timeout: int = 0):
+    # Долгий опрос бота: новых сообщений никогда нет
+    await asyncio.sleep(min(timeout, 30))
+    return {"ok": True, "result": []}
+
+if __name__ == "__main__":
+    uvicorn.run(app, host="0.0.0.0", port=args.port)
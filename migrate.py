@@ -1,5 +1,5 @@
 from app.database import engine
-from app.models import Category, Product, CashDesk
+from app.models import Category, Product, CashDesk, DailySubsidyUsage
 from sqlalchemy import text
 Category.__table__.create(bind=engine, checkfirst=True)
 Product.__table__.create(bind=engine, checkfirst=True)
@@ -13,4 +13,43 @@ with engine.connect() as conn:
         conn.execute(text("INSERT INTO categories (name) VALUES ('Напитки'), ('Выпечка'), ('Снеки')"))
         conn.execute(text("INSERT INTO products (name, price, category_id) VALUES ('Кофе', 80, 1), ('Чай', 40, 1), ('Пицца', 150, 2)"))
         conn.commit()
+
+with engine.connect() as conn:
+    # Состояние liveness-сессии для общего хранилища (LIVENESS_STORE=db)
+    conn.execute(text("ALTER TABLE liveness_sessions ADD COLUMN IF NOT EXISTS state JSON"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_liveness_sessions_timestamp ON liveness_sessions (timestamp)"))
+    # Сотрудник, найденный при старте оплаты — /pay не ищет карту повторно
+    conn.execute(text("ALTER TABLE liveness_sessions ADD COLUMN IF NOT EXISTS employee_id INTEGER REFERENCES employees(id)"))
+    conn.commit()
+
+# Таблицу дотаций создаёт и приложение при старте, но миграцию могут запустить раньше него
+DailySubsidyUsage.__table__.create(bind=engine, checkfirst=True)
+with engine.connect() as conn:
+    # Атомарное списание дотации (UPDATE ... RETURNING); для таблиц, созданных до этой колонки
+    conn.execute(text("ALTER TABLE daily_subsidy_usage ADD COLUMN IF NOT EXISTS last_applied_kopecks INTEGER NOT NULL DEFAULT 0"))
+    conn.commit()
+
+with engine.connect() as conn:
+    # Idempotency-Key касс: повтор запроса не создаёт вторую транзакцию
+    conn.execute(text("ALTER TABLE transactions ADD COLUMN IF NOT EXISTS idempotency_key VARCHAR"))
+    conn.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS ix_transactions_idempotency_key ON transactions (idempotency_key)"))
+    conn.commit()
+
+with engine.connect() as conn:
+    # Поиск в списке сотрудников: имя по вхождению (pg_trgm), карта по началу UID
+    try:
+        conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_employees_full_name_trgm ON employees USING gin (full_name gin_trgm_ops)"))
+        conn.commit()
+    except Exception as e:
+        print(f"⚠️ pg_trgm недоступен, поиск по имени без индекса: {e}")
+        conn.rollback()
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_cards_uid_pattern ON cards (uid text_pattern_ops)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_cards_employee_id ON cards (employee_id)"))
+    conn.commit()
+
+with engine.connect() as conn:
+    # Выгрузка и отчёты фильтруют по диапазону created_at
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_transactions_created_at ON transactions (created_at)"))
+    conn.commit()
 print("✅ БД обновлена!")
@@ -0,0 +1,47 @@
+# Переводит Employee.face_embedding из pickle в компактный формат app/face_codec.py.
+# Запуск: python migrate_embeddings.py [--batch-size 500] [--dry-run]
+import argparse
+from app.database import SessionLocal
+from app.models import Employee
+from app.face_codec import encode_embedding, decode_embedding, is_legacy
+from app.face_store import FACE_VERSION_KEY
+from app.cache_versions import bump_version
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--batch-size", type=int, default=500)
+parser.add_argument("--dry-run", action="store_true")
+args = parser.parse_args()
+
+db = SessionLocal()
+last_id, converted, skipped, failed = 0, 0, 0, 0
+try:
+    while True:
+        # Идём по id (keyset), чтобы не держать в памяти всю таблицу
+        rows = db.query(Employee.id, Employee.face_embedding).filter(
+            Employee.id > last_id, Employee.face_embedding.isnot(None)
+        ).order_by(Employee.id).limit(args.batch_size).all()
+        if not rows:
+            break
+        updates = []
+        for emp_id, blob in rows:
+            if not is_legacy(blob):
+                skipped += 1
+                continue
+            try:
+                updates.append({"id": emp_id, "face_embedding": encode_embedding(decode_embedding(blob))})
+            except Exception as e:
+                print(f"⚠️ Сотрудник {emp_id}: {e}")
+                failed += 1
+        if updates and not args.dry_run:
+            db.bulk_update_mappings(Employee, updates)
+            db.commit()
+        converted += len(updates)
+        last_id = rows[-1][0]
+        print(f"... обработано до id={last_id}, конвертировано {converted}")
+    if converted and not args.dry_run:
+        # Воркеры перечитают шаблоны в новом формате
+        bump_version(db, FACE_VERSION_KEY)
+        db.commit()
+finally:
+    db.close()
+print(f"✅ Готово: конвертировано {converted}, уже в новом формате {skipped}, ошибок {failed}" + (" (dry run)" if args.dry_run else ""))
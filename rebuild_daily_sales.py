@@ -0,0 +1,43 @@
+# Сверка и пересборка сводки продаж по дням (daily_sales) по таблице transactions.
+# Запуск: python rebuild_daily_sales.py [--since 2024-01-01] [--rebuild]
+# Без --rebuild только сверяет и печатает расхождения. Первый запуск после обновления — с --rebuild (заполнение истории).
+import argparse
+from datetime import date, datetime, time
+from sqlalchemy.dialects.postgresql import insert
+from app.database import SessionLocal
+from app.models import DailySales
+from app.ledger import daily_sales_from_transactions
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--since", type=date.fromisoformat)
+parser.add_argument("--rebuild", action="store_true")
+args = parser.parse_args()
+since = datetime.combine(args.since, time.min) if args.since else None
+
+db = SessionLocal()
+try:
+    expected = {(r.day, r.cash_desk_id, r.payment_method): (int(r.amount_kopecks or 0), int(r.tx_count))
+                for r in db.execute(daily_sales_from_transactions(since))}
+    q = db.query(DailySales)
+    if args.since:
+        q = q.filter(DailySales.day >= args.since)
+    actual = {(r.day, r.cash_desk_id, r.payment_method): (r.amount_kopecks, r.tx_count) for r in q}
+
+    mismatches = [(k, expected.get(k, (0, 0)), actual.get(k, (0, 0))) for k in sorted(set(expected) | set(actual), key=str)
+                  if expected.get(k, (0, 0)) != actual.get(k, (0, 0))]
+    for (day, desk, method), exp, act in mismatches[:50]:
+        print(f"⚠️ {day}, касса {desk}, {method}: по транзакциям {exp[0]} коп./{exp[1]} шт., в сводке {act[0]} коп./{act[1]} шт.")
+    print(f"Сверено {len(expected)} записей, расхождений: {len(mismatches)}")
+
+    if args.rebuild:
+        # Пересобираем одной транзакцией: удаляем диапазон и вставляем INSERT ... SELECT
+        d = db.query(DailySales)
+        if args.since:
+            d = d.filter(DailySales.day >= args.since)
+        d.delete(synchronize_session=False)
+        src = daily_sales_from_transactions(since)
+        db.execute(insert(DailySales).from_select(["day", "cash_desk_id", "payment_method", "amount_kopecks", "tx_count"], src))
+        db.commit()
+        print("✅ Сводка пересобрана")
+finally:
+    db.close()
@@ -0,0 +1,42 @@
+# Сверка и пересборка дневного счётчика дотаций (daily_subsidy_usage) по таблице transactions.
+# Запуск: python rebuild_subsidy_usage.py [--since 2024-01-01] [--rebuild]
+# Без --rebuild только сверяет и печатает расхождения.
+import argparse
+from datetime import date, datetime, time
+from sqlalchemy.dialects.postgresql import insert
+from app.database import SessionLocal
+from app.models import DailySubsidyUsage
+from app.ledger import subsidy_usage_from_transactions
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--since", type=date.fromisoformat)
+parser.add_argument("--rebuild", action="store_true")
+args = parser.parse_args()
+since = datetime.combine(args.since, time.min) if args.since else None
+
+db = SessionLocal()
+try:
+    expected = {(r.employee_id, r.day): int(r.used_kopecks) for r in db.execute(subsidy_usage_from_transactions(since))}
+    q = db.query(DailySubsidyUsage)
+    if args.since:
+        q = q.filter(DailySubsidyUsage.day >= args.since)
+    actual = {(r.employee_id, r.day): r.used_kopecks for r in q}
+
+    mismatches = [(k, expected.get(k, 0), actual.get(k, 0)) for k in sorted(set(expected) | set(actual), key=str)
+                  if expected.get(k, 0) != actual.get(k, 0)]
+    for (emp_id, day), exp, act in mismatches[:50]:
+        print(f"⚠️ Сотрудник {emp_id}, {day}: по транзакциям {exp}, в счётчике {act}")
+    print(f"Сверено {len(expected)} записей, расхождений: {len(mismatches)}")
+
+    if args.rebuild:
+        # Пересобираем одной транзакцией: удаляем диапазон и вставляем INSERT ... SELECT
+        d = db.query(DailySubsidyUsage)
+        if args.since:
+            d = d.filter(DailySubsidyUsage.day >= args.since)
+        d.delete(synchronize_session=False)
+        src = subsidy_usage_from_transactions(since)
+        db.execute(insert(DailySubsidyUsage).from_select(["employee_id", "day", "used_kopecks"], src))
+        db.commit()
+        print("✅ Счётчик пересобран")
+finally:
+    db.close()
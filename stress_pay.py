@@ -0,0 +1,85 @@
+# Нагрузочная проверка конкурентных оплат одной картой: лимит не уходит в минус,
+# дотация не тратится дважды, сумма списаний сходится с остатком.
+# Запуск (на тестовой базе!): python stress_pay.py --card 04A1B2C3 [--url http://localhost:8000] [--n 50] [--amount 150]
+# Расход дотации сверяется с таблицей daily_subsidy_usage, поэтому DATABASE_URL должен указывать на ту же базу
+import argparse
+import uuid
+from datetime import date
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from sqlalchemy import func
+from app.database import SessionLocal
+from app.models import Card, DailySubsidyUsage, Transaction
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--url", default="http://localhost:8000")
+parser.add_argument("--card", required=True)
+parser.add_argument("--n", type=int, default=50, help="Сколько оплат отправить одновременно")
+parser.add_argument("--amount", type=int, default=150, help="Сумма каждой оплаты, руб.")
+args = parser.parse_args()
+api = args.url.rstrip("/") + "/api"
+http = requests.Session()
+
+def checkout():
+    r = http.post(f"{api}/checkout/start", params={"card_uid": args.card}, timeout=10)
+    r.raise_for_status()
+    return r.json()
+
+RUN_ID = uuid.uuid4().hex[:8]
+
+def subsidy_used_kop():
+    db = SessionLocal()
+    try:
+        return db.query(func.coalesce(func.sum(DailySubsidyUsage.used_kopecks), 0)).join(
+            Card, Card.employee_id == DailySubsidyUsage.employee_id
+        ).filter(Card.uid == args.card, DailySubsidyUsage.day == date.today()).scalar()
+    finally:
+        db.close()
+
+def subsidy_applied_kop():
+    # Сколько дотации досталось успешным оплатам этого прогона (по их Idempotency-Key)
+    db = SessionLocal()
+    try:
+        return db.query(func.coalesce(func.sum(Transaction.subsidy_part_kopecks), 0)).filter(
+            Transaction.idempotency_key.like(f"stress-{RUN_ID}-%")
+        ).scalar()
+    finally:
+        db.close()
+
+def pay(session_id):
+    r = requests.post(f"{api}/pay", headers={"Idempotency-Key": f"stress-{RUN_ID}-{session_id}"}, json={
+        "session_id": session_id, "amount_rub": args.amount, "cash_desk_id": "stress",
+        "items": [{"name": "Стресс-тест", "price": args.amount}],
+    }, timeout=30)
+    return r.status_code, r.json()
+
+before = checkout()
+used_before = subsidy_used_kop()
+sessions = [checkout()["session_id"] for _ in range(args.n)]
+with ThreadPoolExecutor(max_workers=args.n) as pool:
+    results = list(pool.map(pay, sessions))
+after = checkout()
+used_after = subsidy_used_kop()
+applied = subsidy_applied_kop()
+
+ok = sum(1 for code, _ in results if code == 200)
+declined = sum(1 for code, body in results if code == 400)
+errors = [(code, body) for code, body in results if code not in (200, 400)]
+
+# subsidy_left_rub обрезан снизу нулём и перерасход не показывает — сверяем с самой таблицей
+subsidy_spent = round((used_after - used_before) / 100, 2)
+subsidy_over = used_after > int(round(before["subsidy_rub"] * 100))
+limit_spent = round(before["month_limit_rub"] - after["month_limit_rub"], 2)
+expected_limit_spent = round(ok * args.amount - subsidy_spent, 2)
+
+print(f"Успешно: {ok}, отказ по лимиту: {declined}, ошибок: {len(errors)}")
+print(f"Лимит: {before['month_limit_rub']} → {after['month_limit_rub']} ₽ (списано {limit_spent}, ожидалось {expected_limit_spent})")
+print(f"Дотация за день: использовано {used_before / 100:.2f} → {used_after / 100:.2f} ₽ из {before['subsidy_rub']} ₽, "
+      f"в транзакциях прогона {applied / 100:.2f} ₽")
+for code, body in errors[:5]:
+    print(f"⚠️ HTTP {code}: {body}")
+
+failed = (after["month_limit_rub"] < 0 or limit_spent != expected_limit_spent or errors
+          or subsidy_over or used_after - used_before != applied)
+print("❌ Найдены расхождения" if failed else "✅ Списания согласованы")
+raise SystemExit(1 if failed else 0)